@@ -6,4 +6,9 @@ from Cython.Build import cythonize
 include_path = [numpy.get_include()]
 ext_modules = cythonize("src/pansim/*.pyx")
 
+# The numpy visit computation backend is used
+# on hosts where the extensions fail to compile
+for ext in ext_modules:
+    ext.optional = True
+
 setup(ext_modules=ext_modules, include_dirs=include_path)
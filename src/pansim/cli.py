@@ -5,6 +5,9 @@ import click_completion
 
 from .simplesim import simplesim
 from .distsim import distsim
+from .visitcheck import visitcheck
+from .visitbench import visitbench
+from .remapids import remapids
 
 
 @click.group()
@@ -14,4 +17,7 @@ def cli():
 
 cli.add_command(simplesim)
 cli.add_command(distsim)
+cli.add_command(visitcheck)
+cli.add_command(visitbench)
+cli.add_command(remapids)
 click_completion.init()
@@ -0,0 +1,162 @@
+"""Counter based random number generation for agents."""
+
+import numpy as np
+
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint32(0x9E3779B9)
+PHILOX_W1 = np.uint32(0xBB67AE85)
+PHILOX_ROUNDS = 10
+
+MASK32 = np.uint64(0xFFFFFFFF)
+SHIFT32 = np.uint64(32)
+
+
+def _mulhilo(m, x):
+    """Return the high and low words of the 64 bit product m * x."""
+    p = m * x.astype(np.uint64)
+    return (p >> SHIFT32).astype(np.uint32), (p & MASK32).astype(np.uint32)
+
+
+def philox4x32(counter, key):
+    """Compute the Philox4x32-10 blocks of the given counters and keys.
+
+    counter is a sequence of four uint32 arrays, key a sequence of two.
+    Returns four uint32 arrays.
+    """
+    c0, c1, c2, c3 = (np.asarray(c, dtype=np.uint32) for c in counter)
+    k0, k1 = (np.asarray(k, dtype=np.uint32) for k in key)
+
+    with np.errstate(over="ignore"):
+        for r in range(PHILOX_ROUNDS):
+            if r > 0:
+                k0 = k0 + PHILOX_W0
+                k1 = k1 + PHILOX_W1
+            hi0, lo0 = _mulhilo(PHILOX_M0, c0)
+            hi1, lo1 = _mulhilo(PHILOX_M1, c2)
+            c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+
+    return c0, c1, c2, c3
+
+
+def _split64(x):
+    """Return the low and high 32 bit words of 64 bit integers."""
+    x = np.asarray(x).astype(np.uint64)
+    return (x & MASK32).astype(np.uint32), (x >> SHIFT32).astype(np.uint32)
+
+
+def _to_double(a, b):
+    """Return the doubles in [0, 1) made from the top 53 bits of two words."""
+    a = (a >> np.uint32(5)).astype(np.float64)
+    b = (b >> np.uint32(6)).astype(np.float64)
+    return (a * 67108864.0 + b) / 9007199254740992.0
+
+
+class AgentRandom:
+    """Independent random number streams of a set of agents.
+
+    The i-th block of agent pid at a given tick is the Philox4x32-10 block
+    with key = seed and counter = (pid, tick, i).
+    So the numbers an agent gets depend only on the seed, its pid, the tick
+    and the number of earlier draws it made in the tick;
+    not on which other agents are drawn together or on which rank.
+
+    The methods mirror those of numpy.random.Generator,
+    with one value drawn for every agent.
+    """
+
+    def __init__(self, seed, pid, tick, _draw=None, _index=None):
+        """Initialize."""
+        self.seed = seed
+        self.pid = np.asarray(pid, dtype=np.int64)
+        self.tick = tick
+
+        if _draw is None:
+            _draw = np.zeros(len(self.pid), dtype=np.uint32)
+            _index = np.arange(len(self.pid))
+        self._draw = _draw
+        self._index = _index
+
+        self._key = _split64(seed)
+        self._pid_lo, self._pid_hi = _split64(self.pid)
+        self._tick = np.uint32(tick)
+
+    def __len__(self):
+        """Return the number of agents."""
+        return len(self.pid)
+
+    def subset(self, index):
+        """Return the streams of a subset of the agents.
+
+        Draws made from the subset advance the streams of this object as well.
+        """
+        return AgentRandom(
+            self.seed,
+            self.pid[index],
+            self.tick,
+            _draw=self._draw,
+            _index=self._index[index],
+        )
+
+    def _check_size(self, size):
+        """Check that size, if given, is the number of agents."""
+        if size is not None and size != len(self):
+            raise ValueError("Can only draw one value for every agent.")
+
+    def _next_block(self):
+        """Return the next Philox block of every agent."""
+        draw = self._draw[self._index]
+        self._draw[self._index] += np.uint32(1)
+
+        tick = np.full(len(self), self._tick, dtype=np.uint32)
+        counter = (self._pid_lo, self._pid_hi, tick, draw)
+        return philox4x32(counter, self._key)
+
+    def random(self, size=None):
+        """Return a uniform double in [0, 1) for every agent."""
+        self._check_size(size)
+        x0, x1, _, _ = self._next_block()
+        return _to_double(x0, x1)
+
+    def standard_normal(self, size=None):
+        """Return a standard normal sample for every agent."""
+        self._check_size(size)
+        x0, x1, x2, x3 = self._next_block()
+        u = 1.0 - _to_double(x0, x1)
+        v = _to_double(x2, x3)
+        return np.sqrt(-2.0 * np.log(u)) * np.cos(2.0 * np.pi * v)
+
+    def gamma(self, shape, scale=1.0, size=None):
+        """Return a gamma distribution sample for every agent.
+
+        Uses the Marsaglia and Tsang method;
+        every agent draws until it gets accepted.
+        """
+        self._check_size(size)
+        if shape <= 0.0:
+            raise ValueError("Gamma shape must be positive.")
+        if shape < 1.0:
+            x = self.gamma(shape + 1.0)
+            u = self.random()
+            return x * u ** (1.0 / shape) * scale
+
+        d = shape - 1.0 / 3.0
+        c = 1.0 / np.sqrt(9.0 * d)
+
+        out = np.zeros(len(self), dtype=np.float64)
+        pending = np.arange(len(self))
+        while len(pending):
+            rng = self.subset(pending)
+            x = rng.standard_normal()
+            u = rng.random()
+
+            v = (1.0 + c * x) ** 3
+            with np.errstate(invalid="ignore", divide="ignore"):
+                accept = (v > 0.0) & (
+                    np.log(u) < 0.5 * x * x + d - d * v + d * np.log(v)
+                )
+
+            out[pending[accept]] = d * v[accept]
+            pending = pending[~accept]
+
+        return out * scale
@@ -1,13 +1,69 @@
 """PyArrow schema for data exchange."""
 
+import numpy as np
 import pyarrow as pa
 
+ID_TYPES = {"int64": pa.int64(), "int32": pa.int32()}
 
-def make_visit_schema(visual_attributes):
+
+def get_id_type(id_type):
+    """Return the arrow type of the lid and pid columns."""
+    if id_type not in ID_TYPES:
+        raise ValueError("Unknown id type: %r" % id_type)
+    return ID_TYPES[id_type]
+
+
+def has_column(data, name):
+    """Check if a pandas dataframe or an arrow table has the column."""
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        return name in data.schema.names
+    return name in data.columns
+
+
+def column_names(data):
+    """Return the column names of a pandas dataframe or an arrow table."""
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        return list(data.schema.names)
+    return list(data.columns)
+
+
+def column_to_numpy(data, name, dtype=None):
+    """Return a column of a pandas dataframe or an arrow table as an array.
+
+    The arrow columns are converted without copying when possible.
+    """
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        col = data.column(name).to_numpy()
+        if dtype is not None:
+            col = col.astype(dtype, copy=False)
+        return col
+    return data[name].to_numpy(dtype=dtype)
+
+
+def saturate_counts(visit_outputs, schema):
+    """Clip the counts of the visit output columns to the range of the schema types.
+
+    The counts are the integer columns other than the ids.
+    They are int16 in the compact schema,
+    which a crowded location can overflow.
+    """
+    visit_outputs = dict(visit_outputs)
+    for field in schema:
+        if field.name in ("lid", "pid") or field.name not in visit_outputs:
+            continue
+        if pa.types.is_integer(field.type):
+            info = np.iinfo(field.type.to_pandas_dtype())
+            visit_outputs[field.name] = np.clip(
+                visit_outputs[field.name], info.min, info.max
+            )
+    return visit_outputs
+
+
+def make_visit_schema(visual_attributes, id_type="int64"):
     """Return the visit schema."""
     schema = [
-        ("lid", pa.int64()),
-        ("pid", pa.int64()),
+        ("lid", get_id_type(id_type)),
+        ("pid", get_id_type(id_type)),
         ("group", pa.int8()),
         ("state", pa.int8()),
         ("behavior", pa.int8()),
@@ -27,14 +83,25 @@ def make_visit_schema(visual_attributes):
     return pa.schema(schema)
 
 
-def make_visit_output_schema(visual_attributes):
-    """Return the visit output schema."""
+def make_visit_output_schema(
+    visual_attributes, log_survival=False, id_type="int64", compact=False
+):
+    """Return the visit output schema.
+
+    If compact, the probabilities are float32 and the counts int16;
+    larger counts are saturated with saturate_counts.
+    """
+    prob_type = pa.float32() if compact else pa.float64()
+    count_type = pa.int16() if compact else pa.int32()
+
     schema = [
-        ("lid", pa.int64()),
-        ("pid", pa.int64()),
-        ("inf_prob", pa.float64()),
-        ("n_contacts", pa.int32()),
+        ("lid", get_id_type(id_type)),
+        ("pid", get_id_type(id_type)),
+        ("inf_prob", prob_type),
+        ("n_contacts", count_type),
     ]
+    if log_survival:
+        schema.append(("log_survival", prob_type))
 
     columns = set(k for k, _ in schema)
     for attr in visual_attributes:
@@ -44,16 +111,16 @@ def make_visit_output_schema(visual_attributes):
             )
         columns.add(attr)
 
-        field = (attr, pa.int32())
+        field = (attr, count_type)
         schema.append(field)
 
     return pa.schema(schema)
 
 
-def make_state_schema():
+def make_state_schema(id_type="int64"):
     """Return the person state schema."""
     schema = [
-        ("pid", pa.int64()),
+        ("pid", get_id_type(id_type)),
         ("group", pa.int8()),
         ("current_state", pa.int8()),
         ("next_state", pa.int8()),
@@ -62,3 +129,12 @@ def make_state_schema():
     ]
 
     return pa.schema(schema)
+
+
+def make_state_delta_schema(id_type="int64"):
+    """Return the person state delta schema.
+
+    The dwell time is the one left at the end of tick dwell_tick.
+    """
+    schema = make_state_schema(id_type)
+    return schema.append(pa.field("dwell_tick", pa.int32()))
@@ -1,21 +1,20 @@
 """PanSim Disease Model."""
 
-import random
-
 import toml
 import numpy as np
 
+from .counter_rng import AgentRandom
+from .data_schema import column_names, column_to_numpy
 from .sampler import FixedSampler, CategoricalSampler, GammaDistributionSampler
 
-# from .visit_computation_py import (
-#         compute_visit_output_py as compute_visit_output,
-#         START_EVENT,
-#         END_EVENT
-# )
-from .visit_computation_cy import (
-    compute_visit_output_cy as compute_visit_output,
+from .visit_computation import (
+    get_visit_backend,
     START_EVENT,
     END_EVENT,
+    PAIRWISE_TRANSMISSION,
+    CLASS_TRANSMISSION,
+    PROB_ACCUMULATION,
+    LOG_SURVIVAL_ACCUMULATION,
 )
 
 # from line_profiler import LineProfiler
@@ -27,24 +26,108 @@ SEED_MAX = np.iinfo(np.int64).max
 NULL_STATE = -1
 NULL_DWELL_TIME = -1
 
-
-def psum(ps, axis=-1):
-    """Add the probabilites."""
-    ps = 1.0 - ps
-    ps = np.product(ps, axis=axis)
-    ps = 1.0 - ps
-    return ps
+TRANSMISSION_MODES = {
+    "pairwise": PAIRWISE_TRANSMISSION,
+    "class": CLASS_TRANSMISSION,
+}
+
+VISIT_OUTPUT_AGGREGATIONS = {
+    "sum": np.add,
+    "max": np.maximum,
+    "min": np.minimum,
+}
+
+ACCUMULATION_MODES = {
+    "prob": PROB_ACCUMULATION,
+    "log_survival": LOG_SURVIVAL_ACCUMULATION,
+}
+
+
+def group_indices(keys):
+    """Return (key, indices) pairs for every unique key."""
+    order = np.argsort(keys, kind="stable")
+    uniq, starts = np.unique(keys[order], return_index=True)
+    return zip(uniq, np.split(order, starts[1:]))
+
+
+def combine_visit_outputs(visit_outputs, aggregation=None):
+    """Combine the visit outputs of every person into a single row.
+
+    The visit outputs can be a pandas dataframe or an arrow table.
+    The infection probabilities are combined in survival space;
+    the contact and attribute counts are aggregated as given
+    in aggregation (column -> "sum", "max" or "min"), summed by default.
+    The lid of a combined row is -1,
+    and the counts are saturated to the range of their dtype.
+    Returns a dict of columns sorted by pid.
+    """
+    aggregation = {} if aggregation is None else aggregation
+    names = column_names(visit_outputs)
+
+    pid = column_to_numpy(visit_outputs, "pid", np.int64)
+    order = np.argsort(pid, kind="stable")
+    uniq, starts = np.unique(pid[order], return_index=True)
+    if len(uniq) == 0:
+        return {name: column_to_numpy(visit_outputs, name) for name in names}
+
+    combined = {}
+    for name in names:
+        col = column_to_numpy(visit_outputs, name)[order]
+        if name == "pid":
+            combined[name] = uniq
+        elif name == "lid":
+            combined[name] = np.full(len(uniq), -1, dtype=col.dtype)
+        elif name == "inf_prob":
+            survival = np.multiply.reduceat(1.0 - col.astype(np.float64), starts)
+            combined[name] = 1.0 - survival
+        elif name == "log_survival":
+            combined[name] = np.add.reduceat(col.astype(np.float64), starts)
+        else:
+            how = aggregation.get(name, "sum")
+            if how not in VISIT_OUTPUT_AGGREGATIONS:
+                raise ValueError("Unknown visit output aggregation: %r" % how)
+            ufunc = VISIT_OUTPUT_AGGREGATIONS[how]
+            if np.issubdtype(col.dtype, np.integer):
+                # The counts are aggregated in int64 and saturated,
+                # as the compact int16 counts can overflow
+                info = np.iinfo(col.dtype)
+                col = ufunc.reduceat(col.astype(np.int64), starts)
+                combined[name] = np.clip(col, info.min, info.max).astype(info.dtype)
+            else:
+                combined[name] = ufunc.reduceat(col, starts)
+    return combined
 
 
 class DiseaseModel:
     """The disease model structure."""
 
-    def __init__(self, fname=None, model_dict=None):
+    def __init__(
+        self,
+        fname=None,
+        model_dict=None,
+        transmission_mode="pairwise",
+        accumulation_mode="prob",
+        num_threads=1,
+        visit_backend="auto",
+        seed=0,
+    ):
         """Initialize."""
         if (fname is None) == (model_dict is None):
             raise ValueError(
                 "One and only one of 'fname' or 'model_dict' must be provided."
             )
+        if transmission_mode not in TRANSMISSION_MODES:
+            raise ValueError(
+                "Only transmission modes supported are: %s"
+                % ", ".join(TRANSMISSION_MODES)
+            )
+        if accumulation_mode not in ACCUMULATION_MODES:
+            raise ValueError(
+                "Only accumulation modes supported are: %s"
+                % ", ".join(ACCUMULATION_MODES)
+            )
+        if num_threads < 1:
+            raise ValueError("Number of threads must be positive.")
 
         if fname is not None:
             with open(fname, "rt") as fobj:
@@ -52,6 +135,13 @@ class DiseaseModel:
 
         self.fname = fname
         self.model_dict = model_dict
+        self.transmission_mode = transmission_mode
+        self.accumulation_mode = accumulation_mode
+        self.num_threads = num_threads
+        self.seed = seed
+        self.visit_backend, self._compute_visit_output_batch = get_visit_backend(
+            visit_backend
+        )
 
         self.name_state = {s: i for i, s in enumerate(model_dict["states"])}
         self.name_group = {g: i for i, g in enumerate(model_dict["groups"])}
@@ -70,6 +160,7 @@ class DiseaseModel:
         # print(self.infectivity)
         self.transmission_prob = self._compute_transmission_prob()
         # print(self.transmission_prob)
+        self.log_survival_prob = self._compute_log_survival_prob()
 
         self.progression = self._compute_progression()
         self.dwell_time = self._compute_dwell_time()
@@ -165,6 +256,11 @@ class DiseaseModel:
 
         return transmission_prob
 
+    def _compute_log_survival_prob(self):
+        """Compute the log survival probability log(1 - transmission_prob)."""
+        with np.errstate(divide="ignore"):
+            return np.log1p(-self.transmission_prob)
+
     def _compute_progression(self):
         """Return the progression data structure."""
         groups = self.model_dict["groups"]
@@ -229,60 +325,108 @@ class DiseaseModel:
         # print(dwell_time)
         return dwell_time
 
-    # @profile
     def compute_visit_output(self, visits, visual_attributes, lid):
-        """Compute the visit results."""
-        # pd.set_option("display.max_rows", None, "display.max_columns", None)
-        # pd.options.display.width = 0
-        # print(visits.reset_index())
+        """Compute the visit results of a single location."""
+        visits = visits.assign(lid=lid)
+        return self.compute_visit_outputs(visits, visual_attributes)
+
+    def split_visits(self, visits, n_chunks):
+        """Split the visits into chunks of whole locations of about equal cost.
+
+        The cost of a location is its number of visit pairs
+        with the pairwise transmission, and its number of visits otherwise.
+        The costliest locations come first.
+        Returns the row indices of the visits of every non empty chunk.
+        """
+        v_lid = column_to_numpy(visits, "lid", np.int64)
+        if n_chunks <= 1 or len(v_lid) == 0:
+            return [np.arange(len(v_lid))]
+
+        _, l_inverse, l_counts = np.unique(
+            v_lid, return_inverse=True, return_counts=True
+        )
+        cost = l_counts.astype(np.float64)
+        if self.transmission_mode == "pairwise":
+            cost = cost * cost
+
+        # A location goes to the chunk its cost starts in
+        l_order = np.argsort(-cost, kind="stable")
+        cum_cost = np.cumsum(cost[l_order])
+        start_cost = cum_cost - cost[l_order]
+        l_chunk = np.empty(len(cost), dtype=np.int64)
+        l_chunk[l_order] = np.minimum(
+            (start_cost * n_chunks / cum_cost[-1]).astype(np.int64), n_chunks - 1
+        )
 
+        v_chunk = l_chunk[l_inverse]
+        v_order = np.argsort(v_chunk, kind="stable")
+        bounds = np.searchsorted(v_chunk[v_order], np.arange(n_chunks + 1))
+        return [v_order[b:e] for b, e in zip(bounds[:-1], bounds[1:]) if e > b]
+
+    def compute_visit_outputs(self, visits, visual_attributes):
+        """Compute the visit results of all locations in one batch.
+
+        The visits can be a pandas dataframe or an arrow table.
+        """
         n_visits = len(visits)
-        n_attributes = len(visual_attributes)
 
         transmission_prob = self.transmission_prob
         succeptibility = self.succeptibility
         infectivity = self.infectivity
         unit_time = self.unit_time
+        transmission_mode = TRANSMISSION_MODES[self.transmission_mode]
+        log_survival_prob = self.log_survival_prob
+        accumulation_mode = ACCUMULATION_MODES[self.accumulation_mode]
+
+        # Sort the visits by location and compute the location offsets
+        v_lid = column_to_numpy(visits, "lid", np.int64)
+        v_order = np.argsort(v_lid, kind="stable")
+        v_lid = v_lid[v_order]
+        l_starts = np.flatnonzero(np.diff(v_lid)) + 1
+        l_offsets = np.hstack([[0], l_starts, [n_visits]]).astype(np.int64)
+
+        v_start_time = column_to_numpy(visits, "start_time", np.int32)[v_order]
+        v_end_time = column_to_numpy(visits, "end_time", np.int32)[v_order]
 
         e_event_visit = np.hstack(
             [np.arange(n_visits, dtype=np.int64), np.arange(n_visits, dtype=np.int64)]
         )
-        e_event_time = np.hstack(
-            [
-                visits.start_time.to_numpy(dtype=np.int32),
-                visits.end_time.to_numpy(dtype=np.int32),
-            ]
-        )
+        e_event_lid = np.hstack([v_lid, v_lid])
+        e_event_time = np.hstack([v_start_time, v_end_time])
         e_event_type = np.hstack(
             [
                 np.full(n_visits, START_EVENT, dtype=np.int8),
                 np.full(n_visits, END_EVENT, dtype=np.int8),
             ]
         )
-        e_indices_sorted = np.lexsort([e_event_type, e_event_time])
+        e_indices_sorted = np.lexsort([e_event_type, e_event_time, e_event_lid])
 
-        v_state = visits.state.to_numpy(dtype=np.int8)
-        v_group = visits.group.to_numpy(dtype=np.int8)
-        v_behavior = visits.behavior.to_numpy(dtype=np.int8)
+        v_state = column_to_numpy(visits, "state", np.int8)[v_order]
+        v_group = column_to_numpy(visits, "group", np.int8)[v_order]
+        v_behavior = column_to_numpy(visits, "behavior", np.int8)[v_order]
 
         v_attributes = [
-            visits[attr].to_numpy(dtype=np.int8) for attr in visual_attributes
+            column_to_numpy(visits, attr, np.int8)[v_order] for attr in visual_attributes
         ]
         v_attributes = np.vstack(v_attributes)
 
         vo_inf_prob = np.zeros(n_visits, dtype=np.float64)
         vo_n_contacts = np.zeros(n_visits, dtype=np.int32)
-        vo_attributes = np.zeros((n_attributes, n_visits), dtype=np.int32)
+        vo_attributes = np.zeros((len(visual_attributes), n_visits), dtype=np.int32)
+        vo_log_survival = np.zeros(n_visits, dtype=np.float64)
 
-        compute_visit_output(
+        self._compute_visit_output_batch(
             transmission_prob,
             succeptibility,
             infectivity,
             unit_time,
+            l_offsets,
             e_indices_sorted,
             e_event_visit,
             e_event_time,
             e_event_type,
+            v_start_time,
+            v_end_time,
             v_state,
             v_group,
             v_behavior,
@@ -290,13 +434,16 @@ class DiseaseModel:
             vo_inf_prob,
             vo_n_contacts,
             vo_attributes,
+            transmission_mode,
+            log_survival_prob,
+            vo_log_survival,
+            accumulation_mode,
+            self.num_threads,
         )
+        if accumulation_mode == LOG_SURVIVAL_ACCUMULATION:
+            vo_inf_prob = -np.expm1(vo_log_survival)
 
-        # if np.count_nonzero(vo_inf_prob) > 0:
-        #     print(np.count_nonzero(vo_inf_prob)
-
-        v_pid = visits.pid.to_numpy(dtype=np.int64)
-        v_lid = np.full(n_visits, lid, dtype=np.int64)
+        v_pid = column_to_numpy(visits, "pid", np.int64)[v_order]
 
         visit_outputs = {
             "pid": v_pid,
@@ -304,57 +451,116 @@ class DiseaseModel:
             "inf_prob": vo_inf_prob,
             "n_contacts": vo_n_contacts,
         }
+        if accumulation_mode == LOG_SURVIVAL_ACCUMULATION:
+            visit_outputs["log_survival"] = vo_log_survival
         for i_attr, attr in enumerate(visual_attributes):
             visit_outputs[attr] = vo_attributes[i_attr, :]
 
         return visit_outputs
 
-    # @profile
-    def compute_progression_output(self, state, visit_outputs, tick_time):
-        """Compute the progression outputs."""
-        (pid, group, current_state, next_state, dwell_time, seed) = state
-        # if current_state != 0:
-        #     print(state)
-
-        random.seed(seed)
-
-        # If we are not already in transition
-        if dwell_time == NULL_DWELL_TIME:
-            # Compute the cumulative infection probability
-            inf_p = visit_outputs.inf_prob.to_numpy()
-            inf_p = psum(inf_p)
-
-            # Check if we got exposed
-            if inf_p > 0:
-                # print(inf_p)
-                p = random.random()
-                if p < inf_p:
-                    current_state = self.exposed_state
-                    dwell_time = NULL_DWELL_TIME
-                    next_state = NULL_STATE
-
-        # If we are not already in transition
-        if dwell_time == NULL_DWELL_TIME:
-            # Check if there is a transition defined for the current state
-            if current_state in self.progression:
-                next_state = self.progression[current_state][group].sample()
-                dwell_time = self.dwell_time[current_state][group][next_state].sample()
-
-        # If we are in transition
-        if dwell_time != NULL_DWELL_TIME:
-            if dwell_time > 0:
-                dwell_time = dwell_time - tick_time
-                if dwell_time < 0:
-                    dwell_time = 0
-            else:
-                current_state = next_state
-                dwell_time = NULL_DWELL_TIME
-                next_state = NULL_STATE
-
-        # Get a new seed
-        seed = random.randint(SEED_MIN, SEED_MAX)
-
-        new_state = (pid, group, current_state, next_state, dwell_time, seed)
-        # if current_state != 0:
-        #     print(new_state)
-        return new_state
+    def progression_status(self, state):
+        """Return the number of infectious persons and persons pending processing.
+
+        When both are zero in all ranks
+        no one can get exposed or change state anymore.
+        """
+        infectious = self.infectivity[state.current_state, state.group] > 0.0
+        n_infectious = np.count_nonzero(infectious & state.loaded)
+        n_pending = np.count_nonzero(state.touch_tick >= 0)
+        return int(n_infectious), int(n_pending)
+
+    def compute_progression_outputs(self, state, p_idx, inf_p, tick):
+        """Advance the state of the persons that need processing at the tick.
+
+        p_idx and inf_p are the local indices of the persons with visits
+        and their cumulative infection probabilities,
+        as returned by PersonState.reduce_visit_outputs.
+
+        Only the persons that can get exposed at the tick
+        and the persons scheduled for the tick on the timing wheel
+        are processed; the state is updated in place.
+        A person in transition is scheduled for the tick its dwell time runs out,
+        and a person finishing a transition for the next tick.
+
+        The random numbers of a person come from a counter based generator
+        keyed on (seed, pid, tick),
+        so they don't depend on how the persons are partitioned.
+        The seed column of the state is not used.
+
+        Returns the local indices of the persons whose state at the end of the tick
+        differs from what it would be without processing;
+        that is other than by the dwell time running down.
+        """
+        tick_time = state.tick_time
+
+        exposable = (inf_p > 0) & (state.dwell_time[p_idx] == NULL_DWELL_TIME)
+        idx = np.union1d(state.pop_due(tick), p_idx[exposable])
+
+        pid = state.pid[idx]
+        group = state.group[idx]
+        current_state = state.current_state[idx]
+        next_state = state.next_state[idx]
+        dwell_time = state.dwell_time[idx]
+
+        i_p = np.minimum(np.searchsorted(p_idx, idx), max(len(p_idx) - 1, 0))
+        if len(p_idx):
+            inf_p = np.where(p_idx[i_p] == idx, inf_p[i_p], 0.0)
+        else:
+            inf_p = np.zeros(len(idx), dtype=np.float64)
+
+        rng = AgentRandom(self.seed, pid, tick)
+
+        # Check if we got exposed, if we are not already in transition
+        i_exp = np.flatnonzero((dwell_time == NULL_DWELL_TIME) & (inf_p > 0))
+        p = rng.subset(i_exp).random()
+        i_exp = i_exp[p < inf_p[i_exp]]
+        current_state[i_exp] = self.exposed_state
+        next_state[i_exp] = NULL_STATE
+
+        # If we are not already in transition,
+        # check if there is a transition defined for the current state
+        # all persons in a (state, group) bucket are sampled at once
+        sampled = np.zeros(len(idx), dtype=bool)
+        i_null = np.flatnonzero(dwell_time == NULL_DWELL_TIME)
+        buckets = current_state[i_null] * self.n_groups + group[i_null]
+        for bucket, i_b in group_indices(buckets):
+            cs, g = divmod(int(bucket), self.n_groups)
+            if cs not in self.progression:
+                continue
+
+            i_b = i_null[i_b]
+            sampled[i_b] = True
+            sampler = self.progression[cs][g]
+            next_state[i_b] = sampler.sample_many(len(i_b), rng.subset(i_b))
+
+            for ns, i_ns in group_indices(next_state[i_b]):
+                i_ns = i_b[i_ns]
+                sampler = self.dwell_time[cs][g][int(ns)]
+                dwell_time[i_ns] = sampler.sample_many(len(i_ns), rng.subset(i_ns))
+
+        # If we are in transition,
+        # the transition happens when the dwell time has run out
+        in_transition = dwell_time != NULL_DWELL_TIME
+        waiting = in_transition & sampled & (dwell_time > 0)
+        done = in_transition & ~waiting
+
+        touch_tick = np.full(len(idx), -1, dtype=np.int64)
+        touch_tick[waiting] = tick - (-dwell_time[waiting] // tick_time)
+        dwell_time[waiting] = np.maximum(dwell_time[waiting] - tick_time, 0)
+
+        current_state[done] = next_state[done]
+        dwell_time[done] = NULL_DWELL_TIME
+        next_state[done] = NULL_STATE
+        touch_tick[done] = tick + 1
+
+        changed = state.current_state[idx] != current_state
+        changed |= state.next_state[idx] != next_state
+        changed |= state.dwell_time_left(idx, tick) != dwell_time
+
+        state.current_state[idx] = current_state
+        state.next_state[idx] = next_state
+        state.dwell_time[idx] = dwell_time
+        state.dwell_tick[idx] = tick
+        state.schedule(idx, touch_tick)
+
+        return idx[changed]
@@ -1,20 +1,35 @@
 """Simple single threaded simulation."""
 
 import os
+import json
 import time
+import shutil
 import logging
+import tempfile
+import itertools
 from collections import defaultdict
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.csv as csv
+from mpi4py import MPI
 
 from .simple_behavior import SimpleBehaviorModel
 from .simple_behavior_java import SimpleJavaBehaviorModel
-from .disease_model import DiseaseModel
-from .data_schema import make_visit_schema, make_visit_output_schema, make_state_schema
+from .disease_model import DiseaseModel, combine_visit_outputs
+from .person_state import PersonState
+from .routing import RankLookup, Router
+from .data_schema import (
+    make_visit_schema,
+    make_visit_output_schema,
+    make_state_schema,
+    make_state_delta_schema,
+    saturate_counts,
+)
 
 import xactor as asys
 
@@ -24,17 +39,25 @@ PROG_AID = "progression_actor"
 BEHAV_AID = "behavior_actor"
 CONFIG_AID = "config_actor"
 
+EXCHANGE_MODES = ("actor", "collective")
+IPC_COMPRESSIONS = ("none", "lz4", "zstd")
+
 LOG = asys.getLogger(__name__)
 
 PROCESS_START_TIME = time.perf_counter()
 
+SHM_SEQ = itertools.count()
+
 
 @contextmanager
 def timing(key: str):
+    """Log the duration of the block, along with any stats it adds to the dict."""
+    stats = {}
     start = time.perf_counter() - PROCESS_START_TIME
-    yield
+    yield stats
     end = time.perf_counter() - PROCESS_START_TIME
-    LOG.info("#timing# %s start=%f duration=%f", key, start, end - start)
+    extra = "".join(" %s=%g" % kv for kv in stats.items())
+    LOG.info("#timing# %s start=%f duration=%f%s", key, start, end - start, extra)
 
 
 def get_config():
@@ -42,48 +65,187 @@ def get_config():
     return asys.local_actor(CONFIG_AID)
 
 
-def serialize_df(df, schema):
-    """Serialize a pandas dataframe to bytes."""
+def report_ready(actor_id, start):
+    """Tell the main actor that the actor has finished initializing."""
+    duration = time.perf_counter() - start
+    asys.ActorProxy(asys.MASTER_RANK, MAIN_AID).actor_ready(
+        asys.current_rank(), actor_id, start - PROCESS_START_TIME, duration
+    )
+
+
+def serialize_table(table, compression=None):
+    """Serialize an arrow table to a buffer using the IPC stream format.
+
+    The record batch buffers are compressed with the given codec if any.
+    """
     sink = pa.BufferOutputStream()
-    writer = pa.ipc.new_file(sink, schema)
-    batch = pa.record_batch(df, schema=schema)
-    writer.write_batch(batch)
-    writer.close()
-    raw = sink.getvalue().to_pybytes()
-    return raw
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+class ShmBatch:
+    """A serialized table placed in a node local shared memory file."""
+
+    def __init__(self, path):
+        """Initialize."""
+        self.path = path
+
+
+def serialize_table_shm(table, shm_dir):
+    """Serialize an arrow table to a new shared memory file."""
+    path = os.path.join(shm_dir, "pansim-%d-%d" % (os.getpid(), next(SHM_SEQ)))
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return ShmBatch(path)
+
 
+def unserialize_table(buf):
+    """Reconstruct an arrow table from a buffer without copying the data.
 
-def unserialize_df(raw):
-    """Reconstruct a pandas dataframe from bytes."""
-    fobj = pa.ipc.open_file(raw)
-    batch = fobj.get_batch(0)
-    df = batch.to_pandas()
-    return df
+    Shared memory files are mapped and removed;
+    the mapping stays valid as long as the table is alive.
+    """
+    if isinstance(buf, ShmBatch):
+        source = pa.memory_map(buf.path)
+        os.unlink(buf.path)
+        return pa.ipc.open_stream(source).read_all()
+    return pa.ipc.open_stream(buf).read_all()
 
 
-def df_scatter(df, scatter_col, col_rank, all_ranks, schema, dest_actor, dest_method):
-    """Scatter the dataframe to all ranks."""
+def concat_tables(bufs, schema):
+    """Reconstruct and concatenate the received tables without copying the data."""
+    tables = [unserialize_table(buf) for buf in bufs if buf is not None]
+    if not tables:
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+def table_scatter(
+    table, scatter_col, router, all_ranks, schema, dest_actor, dest_method, end=None
+):
+    """Scatter the table rows to all ranks.
+
+    If end is given the table is one part of a stream:
+    the parts other than the last are sent only to the ranks with rows,
+    and every message carries the end flag.
+    """
+    config = get_config()
     rank_batch = {rank: None for rank in all_ranks}
 
-    if len(df.index):
-        df["dest_rank"] = df[scatter_col].map(col_rank)
-        for rank, group in df.groupby("dest_rank"):
-            batch = serialize_df(group, schema)
-            rank_batch[rank] = batch
+    if table.num_rows:
+        order, ranks, starts, counts = router.split(
+            table.column(scatter_col).to_numpy()
+        )
+        table = table.select(schema.names)
+        if order is not None:
+            table = table.take(order)
+
+        # Large batches leaving the node are compressed
+        compress = []
+        for rank, start, count in zip(ranks, starts, counts):
+            part = table.slice(start, count)
+            if rank in config.shm_ranks:
+                rank_batch[rank] = serialize_table_shm(part, config.shm_dir)
+            elif (
+                config.ipc_compression != "none"
+                and rank not in config.node_ranks
+                and part.nbytes >= config.ipc_compression_threshold
+            ):
+                compress.append((rank, part))
+            else:
+                rank_batch[rank] = serialize_table(part)
+
+        if compress:
+            key = "table_scatter:compress_%s" % dest_method
+            with timing(key) as stats:
+                raw_bytes = compressed_bytes = 0
+                for rank, part in compress:
+                    batch = serialize_table(part, config.ipc_compression)
+                    rank_batch[rank] = batch
+                    raw_bytes += part.nbytes
+                    compressed_bytes += batch.size
+                stats["raw_bytes"] = raw_bytes
+                stats["compressed_bytes"] = compressed_bytes
+                stats["ratio"] = raw_bytes / max(compressed_bytes, 1)
+
+    if config.exchange_mode == "collective":
+        collective_exchange(rank_batch, dest_actor, dest_method)
+        return
 
     for rank, batch in rank_batch.items():
-        msg = asys.Message(dest_method, args=[batch])
+        if end is None:
+            msg = asys.Message(dest_method, args=[batch])
+        elif batch is not None or end:
+            msg = asys.Message(dest_method, args=[batch, end])
+        else:
+            continue
         asys.send(rank, dest_actor, msg)
 
 
+def collective_exchange(rank_batch, dest_actor, dest_method):
+    """Exchange the batches with all-to-all collectives.
+
+    Every rank has to call this for the same exchanges in the same order.
+    The batch sizes are exchanged first, where -1 means no batch is sent,
+    so that the empty batches carry no data.
+    The received batches are passed to the method of the local actor
+    in rank order, with None for the empty ones.
+    """
+    comm = get_config().exchange_comm
+    size = comm.Get_size()
+
+    send_sizes = np.full(size, -1, dtype=np.int64)
+    for rank, batch in rank_batch.items():
+        send_sizes[rank] = 0 if batch is None else batch.size
+    recv_sizes = np.empty(size, dtype=np.int64)
+    comm.Alltoall(send_sizes, recv_sizes)
+
+    send_counts = np.maximum(send_sizes, 0)
+    recv_counts = np.maximum(recv_sizes, 0)
+    send_displs = np.cumsum(send_counts) - send_counts
+    recv_displs = np.cumsum(recv_counts) - recv_counts
+
+    send_buf = np.empty(send_counts.sum(), dtype=np.uint8)
+    for rank, batch in rank_batch.items():
+        if batch is not None:
+            start = send_displs[rank]
+            send_buf[start : start + batch.size] = np.frombuffer(batch, dtype=np.uint8)
+    recv_buf = np.empty(recv_counts.sum(), dtype=np.uint8)
+    comm.Alltoallv(
+        [send_buf, (send_counts, send_displs), MPI.BYTE],
+        [recv_buf, (recv_counts, recv_displs), MPI.BYTE],
+    )
+
+    if (recv_sizes < 0).all():
+        return
+    method = getattr(asys.local_actor(dest_actor), dest_method)
+    for rank in range(size):
+        if recv_sizes[rank] < 0:
+            continue
+        if recv_sizes[rank] == 0:
+            method(None)
+        else:
+            start = recv_displs[rank]
+            method(pa.py_buffer(recv_buf[start : start + recv_counts[rank]]))
+
+
 class LocationActor:
     """Manager of location specific comuputations."""
 
     def __init__(self):
         """Initialize."""
-        self.behav_ranks = get_config().behav_ranks
+        start = time.perf_counter()
+        config = get_config()
+        self.behav_ranks = config.behav_ranks
+        self.visit_output_router = Router(
+            config.pid_prog_rank, max_cached=16 * config.visit_output_chunks
+        )
 
         self.visit_batches = []
+        report_ready(LOC_AID, start)
 
     def visit(self, visit_batch):
         """Get new visits."""
@@ -101,43 +263,52 @@ class LocationActor:
         config = get_config()
         disease_model = config.disease_model
         attr_names = config.attr_names
-        pid_prog_rank = config.pid_prog_rank
         visit_output_schema = config.visit_output_schema
 
         with timing("LocationActor:assemble_visits"):
-            visit_df = [
-                unserialize_df(batch)
-                for batch in self.visit_batches
-                if batch is not None
-            ]
-            if visit_df:
-                visit_df = pd.concat(visit_df, axis=0)
+            visits = concat_tables(self.visit_batches, config.visit_schema)
+
+        # The visit outputs are sent on chunk by chunk,
+        # so the progression ranks can receive them while the rest is computed
+        with timing("LocationActor:split_visits"):
+            chunks = disease_model.split_visits(visits, config.visit_output_chunks)
+
+        for i, chunk in enumerate(chunks):
+            if config.exchange_mode == "collective":
+                end = None
+            else:
+                end = i == len(chunks) - 1
+            if len(chunks) > 1:
+                chunk_visits = visits.take(chunk)
             else:
-                visit_df = get_config().empty_visit_df
+                chunk_visits = visits
 
-        with timing("LocationActor:compute_visit_output"):
-            visit_outputs = defaultdict(list)
-            for lid, group in visit_df.groupby("lid"):
-                visit_output = disease_model.compute_visit_output(
-                    group, attr_names, lid
+            with timing("LocationActor:compute_visit_output"):
+                visit_outputs = disease_model.compute_visit_outputs(
+                    chunk_visits, attr_names
+                )
+                visit_outputs = saturate_counts(visit_outputs, visit_output_schema)
+                visit_outputs = pa.table(visit_outputs, schema=visit_output_schema)
+
+            if config.combine_visit_outputs:
+                with timing("LocationActor:combine_visit_output"):
+                    visit_outputs = combine_visit_outputs(
+                        visit_outputs, config.visit_output_aggregation
+                    )
+                    visit_outputs = pa.table(visit_outputs, schema=visit_output_schema)
+
+            with timing("LocationActor:scatter_visit_output"):
+                LOG.debug("LocationActor: Sending visit output to ProgressionActor")
+                table_scatter(
+                    visit_outputs,
+                    "pid",
+                    self.visit_output_router,
+                    asys.ranks(),
+                    visit_output_schema,
+                    PROG_AID,
+                    "visit_output",
+                    end=end,
                 )
-                for k, v in visit_output.items():
-                    visit_outputs[k].append(v)
-            visit_outputs.default_factory = None
-            visit_outputs = {k: np.hstack(vs) for k, vs in visit_outputs.items()}
-            visit_output_df = pd.DataFrame(visit_outputs)
-
-        with timing("LocationActor:scatter_visit_output"):
-            LOG.debug("LocationActor: Sending visit output to ProgressionActor")
-            df_scatter(
-                visit_output_df,
-                "pid",
-                pid_prog_rank,
-                asys.ranks(),
-                visit_output_schema,
-                PROG_AID,
-                "visit_output",
-            )
 
         self.visit_batches = []
 
@@ -147,29 +318,51 @@ class ProgressionActor:
 
     def __init__(self):
         """Initialize."""
-        self.behav_ranks = get_config().behav_ranks
+        start = time.perf_counter()
+        config = get_config()
+        self.behav_ranks = config.behav_ranks
 
-        self.current_state_batches = []
-        self.visit_output_batches = []
+        pids = config.pid_prog_rank.ids_of(asys.current_rank())
+        self.state = PersonState(pids, config.tick_time)
+        self.new_state_router = Router(config.pid_behav_rank)
+        self.visit_output_router = Router(config.pid_behav_rank)
+
+        self.n_current_state_batches = 0
+        self.visit_outputs = []
+        self.n_visit_output_ends = 0
+        self.cur_tick = 0
+        report_ready(PROG_AID, start)
 
     def current_state(self, current_state_batch):
         """Get the current state."""
         LOG.debug("ProgressionActor: Received current_state")
 
-        self.current_state_batches.append(current_state_batch)
+        if current_state_batch is not None:
+            with timing("ProgressionActor:update_current_state"):
+                self.state.update(unserialize_table(current_state_batch), self.cur_tick)
+        self.n_current_state_batches += 1
         self.try_compute_prgression_output()
 
-    def visit_output(self, visit_output_batch):
-        """Get the visit outputs."""
+    def visit_output(self, visit_output_batch, end=True):
+        """Get the visit outputs.
+
+        A location rank can send its visit outputs in several batches,
+        the last of which has end set.
+        """
         LOG.debug("ProgressionActor: Received visit_output")
-        self.visit_output_batches.append(visit_output_batch)
+
+        if visit_output_batch is not None:
+            with timing("ProgressionActor:unserialize_visit_output"):
+                self.visit_outputs.append(unserialize_table(visit_output_batch))
+        if end:
+            self.n_visit_output_ends += 1
         self.try_compute_prgression_output()
 
     def try_compute_prgression_output(self):
         """Try to run compute_progression_output."""
-        if len(self.current_state_batches) < len(self.behav_ranks):
+        if self.n_current_state_batches < len(self.behav_ranks):
             return
-        if len(self.visit_output_batches) < len(asys.ranks()):
+        if self.n_visit_output_ends < len(asys.ranks()):
             return
 
         self.compute_progression_output()
@@ -178,91 +371,93 @@ class ProgressionActor:
         """Compute disease progression."""
         config = get_config()
         disease_model = config.disease_model
-        pid_behav_rank = config.pid_behav_rank
         behav_ranks = config.behav_ranks
         visit_output_schema = config.visit_output_schema
-        state_schema = config.state_schema
-        tick_time = config.tick_time
-
-        with timing("ProgressionActor:assemble_current_state"):
-            current_state_df = [
-                unserialize_df(batch)
-                for batch in self.current_state_batches
-                if batch is not None
-            ]
-            if current_state_df:
-                current_state_df = pd.concat(current_state_df, axis=0)
-            else:
-                current_state_df = get_config().empty_state_df
+        state_delta_schema = config.state_delta_schema
 
         with timing("ProgressionActor:assemble_visit_output"):
-            visit_output_df = [
-                unserialize_df(batch)
-                for batch in self.visit_output_batches
-                if batch is not None
-            ]
-            if visit_output_df:
-                visit_output_df = pd.concat(visit_output_df, axis=0)
+            if self.visit_outputs:
+                visit_outputs = pa.concat_tables(self.visit_outputs)
             else:
-                visit_output_df = get_config().empty_visit_output_df
+                visit_outputs = visit_output_schema.empty_table()
 
         with timing("ProgressionActor:compute_next_state"):
-            current_state_df = current_state_df.set_index("pid", drop=False)
-            columns = [
-                "pid",
-                "group",
-                "current_state",
-                "next_state",
-                "dwell_time",
-                "seed",
-            ]
-
-            new_states = []
-            for pid, group in visit_output_df.groupby("pid"):
-                cur_state = (current_state_df.at[pid, col] for col in columns)
-                new_state = disease_model.compute_progression_output(
-                    cur_state, group, tick_time
+            p_idx, inf_p = self.state.reduce_visit_outputs(visit_outputs)
+            changed_idx = disease_model.compute_progression_outputs(
+                self.state, p_idx, inf_p, self.cur_tick
+            )
+            new_state = self.state.delta(changed_idx)
+            new_state = pa.table(new_state, schema=state_delta_schema)
+
+        if config.send_visit_outputs and config.combine_visit_outputs:
+            with timing("ProgressionActor:combine_visit_output"):
+                visit_outputs = combine_visit_outputs(
+                    visit_outputs, config.visit_output_aggregation
                 )
-                new_states.append(new_state)
-            new_state_df = pd.DataFrame(new_states, columns=columns)
+                visit_outputs = pa.table(visit_outputs, schema=visit_output_schema)
+
+        with timing("ProgressionActor:send_progression_status"):
+            status = disease_model.progression_status(self.state)
+            asys.ActorProxy(asys.MASTER_RANK, MAIN_AID).progression_status(
+                self.cur_tick, *status
+            )
 
         with timing("ProgressionActor:scatter_next_state"):
             LOG.debug("ProgressionActor: Send out new_state to BehaviorActor")
-            df_scatter(
-                new_state_df,
+            table_scatter(
+                new_state,
                 "pid",
-                pid_behav_rank,
+                self.new_state_router,
                 behav_ranks,
-                state_schema,
+                state_delta_schema,
                 BEHAV_AID,
                 "new_state",
             )
 
-        with timing("ProgressionActor:scatter_visit_output"):
-            LOG.debug("ProgressionActor: Send out visit_output to BehaviorActor")
-            df_scatter(
-                visit_output_df,
-                "pid",
-                pid_behav_rank,
-                behav_ranks,
-                visit_output_schema,
-                BEHAV_AID,
-                "visit_output",
-            )
+        if config.send_visit_outputs:
+            with timing("ProgressionActor:scatter_visit_output"):
+                LOG.debug("ProgressionActor: Send out visit_output to BehaviorActor")
+                table_scatter(
+                    visit_outputs,
+                    "pid",
+                    self.visit_output_router,
+                    behav_ranks,
+                    config.behavior_visit_output_schema,
+                    BEHAV_AID,
+                    "visit_output",
+                )
 
-        self.current_state_batches = []
-        self.visit_output_batches = []
+        self.n_current_state_batches = 0
+        self.visit_outputs = []
+        self.n_visit_output_ends = 0
+        self.cur_tick += 1
 
 
 class BehaviorActor:
     """Manager of agent behavior computations."""
 
     def __init__(self):
+        start = time.perf_counter()
         self.visit_output_batches = []
         self.new_state_batches = []
 
         config = get_config()
-        pid_behav_rank = config.pid_behav_rank
+        self.visit_router = Router(config.lid_rank)
+        self.state_router = Router(config.pid_prog_rank)
+
+        # Mirror of the state owned by the progression ranks,
+        # kept in sync by the state deltas exchanged every tick
+        pids = config.pid_behav_rank.ids_of(asys.current_rank())
+        self.state = PersonState(pids, config.tick_time)
+        self.cur_tick = 0
+
+        # In the pipelined mode the behavior actor starts its own next tick,
+        # and the visits of the next tick are prepared on a separate thread
+        # while the current one is running
+        self.prefetch_executor = None
+        self.prefetch = None
+        if config.pipeline:
+            self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
 
         with timing("BehaviorActor:initalize_behavior_module"):
             if config.java_behavior == 1:
@@ -270,11 +465,13 @@ class BehaviorActor:
                 self.behavior_model = SimpleJavaBehaviorModel()
             else:
                 myrank = asys.current_rank()
-                pids = [pid for pid, rank in pid_behav_rank.items() if rank == myrank]
+                pids = config.pid_behav_rank.ids_of(myrank)
                 seed = config.seed + myrank
 
                 self.behavior_model = SimpleBehaviorModel(seed=seed, pids=pids)
 
+        report_ready(BEHAV_AID, start)
+
     def visit_output(self, visit_output_batch):
         """Get the visit outputs."""
         LOG.debug("BehaviorActor: Received visit_output")
@@ -289,7 +486,8 @@ class BehaviorActor:
 
     def try_run_behavior_model(self):
         """Try running the behavior model."""
-        if len(self.visit_output_batches) < len(asys.ranks()):
+        send_visit_outputs = get_config().send_visit_outputs
+        if send_visit_outputs and len(self.visit_output_batches) < len(asys.ranks()):
             return
         if len(self.new_state_batches) < len(asys.ranks()):
             return
@@ -303,56 +501,78 @@ class BehaviorActor:
         disease_model = config.disease_model
 
         with timing("BehaviorActor:assemble_visit_output"):
-            visit_output_df = [
-                unserialize_df(batch)
-                for batch in self.visit_output_batches
-                if batch is not None
-            ]
-            if visit_output_df:
-                visit_output_df = pd.concat(visit_output_df, axis=0)
-            else:
-                visit_output_df = get_config().empty_visit_output_df
+            visit_outputs = concat_tables(
+                self.visit_output_batches, config.behavior_visit_output_schema
+            )
 
         with timing("BehaviorActor:assemble_next_state"):
-            new_state_df = [
-                unserialize_df(batch)
-                for batch in self.new_state_batches
-                if batch is not None
-            ]
-            if new_state_df:
-                new_state_df = pd.concat(new_state_df, axis=0)
-            else:
-                new_state_df = get_config().empty_state_df
+            delta = concat_tables(self.new_state_batches, config.state_delta_schema)
+            self.state.apply_delta(delta)
+            idx = np.flatnonzero(self.state.loaded)
+            new_state = self.state.columns(idx, self.cur_tick)
+            new_state = pa.table(new_state, schema=config.state_schema)
+
+        if self.prefetch is not None:
+            with timing("BehaviorActor:wait_prefetch"):
+                self.prefetch.result()
+            self.prefetch = None
 
         with timing("BehaviorActor:run_behavior_model"):
-            self.behavior_model.run_behavior_model(new_state_df, visit_output_df)
+            self.behavior_model.run_behavior_model(
+                new_state.to_pandas(), visit_outputs.to_pandas()
+            )
 
         with timing("BehaviorActor:share_epicurve_row"):
             LOG.debug("BehaviorActor: Sening epicurve row to main")
-            state_count = new_state_df.groupby("current_state").agg({"pid": len}).pid
-            epirow = [state_count.get(i, 0) for i in range(disease_model.n_states)]
-            asys.ActorProxy(asys.MASTER_RANK, MAIN_AID).end_tick(epirow)
+            current_state = self.state.current_state[idx]
+            epirow = np.bincount(current_state, minlength=disease_model.n_states)
+            epirow = [int(x) for x in epirow]
+            asys.ActorProxy(asys.MASTER_RANK, MAIN_AID).end_tick(
+                self.cur_tick, epirow, self.behavior_model.needs_every_tick
+            )
 
         self.visit_output_batches = []
         self.new_state_batches = []
+        self.cur_tick += 1
+
+        # The epicurve row is reduced by the main actor in the background
+        if config.pipeline and self.cur_tick < config.num_ticks:
+            self.start_tick()
+
+    def prefetch_tick(self, tick):
+        """Prepare the visits of the tick and their routing ahead of time."""
+        visit_df = self.behavior_model.prepare_tick(tick)
+        lid_type = get_config().visit_schema.field("lid").type.to_pandas_dtype()
+        self.visit_router.split(visit_df.lid.to_numpy().astype(lid_type))
 
     def start_tick(self):
         """Start the next tick."""
         config = get_config()
-        lid_rank = config.lid_rank
-        pid_prog_rank = config.pid_prog_rank
         visit_schema = config.visit_schema
         state_schema = config.state_schema
 
-        current_state_df = self.behavior_model.next_state_df
-        visit_df = self.behavior_model.next_visit_df
+        current_state = pa.Table.from_pandas(
+            self.behavior_model.next_state_df, schema=state_schema, preserve_index=False
+        )
+
+        # Only the rows the progression ranks don't already have are sent
+        with timing("BehaviorActor:compute_state_delta"):
+            _, _, changed = self.state.diff(current_state, self.cur_tick)
+            current_state = current_state.filter(pa.array(changed))
+            dwell_tick = np.full(current_state.num_rows, self.cur_tick - 1)
+            self.state.apply_delta(
+                current_state.append_column("dwell_tick", pa.array(dwell_tick))
+            )
+        visits = pa.Table.from_pandas(
+            self.behavior_model.next_visit_df, schema=visit_schema, preserve_index=False
+        )
 
         with timing("BehaviorActor:scatter_visits"):
             LOG.debug("BehaviorActor: Sending out visit batches to LocationActor")
-            df_scatter(
-                visit_df,
+            table_scatter(
+                visits,
                 "lid",
-                lid_rank,
+                self.visit_router,
                 asys.ranks(),
                 visit_schema,
                 LOC_AID,
@@ -363,16 +583,41 @@ class BehaviorActor:
             LOG.debug(
                 "BehaviorActor: Sending out current state batches to ProgressionActor"
             )
-            df_scatter(
-                current_state_df,
+            table_scatter(
+                current_state,
                 "pid",
-                pid_prog_rank,
+                self.state_router,
                 asys.ranks(),
                 state_schema,
                 PROG_AID,
                 "current_state",
             )
 
+        # Only the behavior models that can prepare their ticks are prefetched
+        if self.prefetch_executor is not None and hasattr(
+            self.behavior_model, "prepare_tick"
+        ):
+            self.prefetch = self.prefetch_executor.submit(
+                self.prefetch_tick, self.cur_tick + 1
+            )
+
+
+class IdleBehaviorActor:
+    """Stand in for the behavior actor on the ranks without one.
+
+    Used with the collective exchange,
+    where every rank has to take part in the behavior actor exchanges.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        report_ready(BEHAV_AID, time.perf_counter())
+
+    def start_tick(self):
+        """Start the next tick."""
+        collective_exchange({}, LOC_AID, "visit")
+        collective_exchange({}, PROG_AID, "current_state")
+
 
 def node_rank(node, cpu):
     """Get the rank of a cpu given node and cpu index."""
@@ -381,59 +626,287 @@ def node_rank(node, cpu):
     return r
 
 
+def node_ranks(node, cpu):
+    """Get the ranks of arrays of node and cpu indices."""
+    node = np.asarray(node, dtype=np.int64)
+    cpu = np.asarray(cpu, dtype=np.int64)
+    pairs, inverse = np.unique(
+        np.stack([node, cpu], axis=1), axis=0, return_inverse=True
+    )
+    ranks = np.array([node_rank(n, c) for n, c in pairs], dtype=np.int64)
+    return ranks[inverse.reshape(-1)]
+
+
+def build_routing_tables(lid_part_file, pid_part_file, per_node_behavior):
+    """Build the rank lookups from the partition files."""
+    lid_part = csv.read_csv(lid_part_file)
+    lid, node, cpu = (col.to_numpy() for col in lid_part.columns)
+    tables = {"lid_rank": RankLookup(lid, node_ranks(node, cpu))}
+
+    pid_part = csv.read_csv(pid_part_file)
+    pid, node, cpu = (col.to_numpy() for col in pid_part.columns)
+    tables["pid_prog_rank"] = RankLookup(pid, node_ranks(node, cpu))
+    if per_node_behavior:
+        cpu = np.zeros_like(cpu)
+        tables["pid_behav_rank"] = RankLookup(pid, node_ranks(node, cpu))
+
+    return tables
+
+
+def routing_tables_key(lid_part_file, pid_part_file, per_node_behavior):
+    """Return what the routing tables depend on."""
+    files = []
+    for fname in [lid_part_file, pid_part_file]:
+        stat = os.stat(fname)
+        files.append([os.path.abspath(fname), stat.st_size, stat.st_mtime_ns])
+
+    layout = [[int(r) for r in asys.node_ranks(node)] for node in asys.nodes()]
+    return {"files": files, "layout": layout, "per_node_behavior": per_node_behavior}
+
+
+def save_routing_tables(tables, table_dir, key):
+    """Save the rank lookups, and what they were built from, to the directory."""
+    modes = {}
+    for name, table in tables.items():
+        table.save(os.path.join(table_dir, name))
+        modes[name] = table.mode
+    with open(os.path.join(table_dir, "key.json"), "w") as fobj:
+        json.dump({"key": key, "tables": modes}, fobj)
+
+
+def load_routing_tables(table_dir):
+    """Memory map the rank lookups saved to the directory."""
+    with open(os.path.join(table_dir, "key.json")) as fobj:
+        modes = json.load(fobj)["tables"]
+
+    tables = {}
+    for name, mode in modes.items():
+        tables[name] = RankLookup.load(os.path.join(table_dir, name), mode)
+    tables.setdefault("pid_behav_rank", tables["pid_prog_rank"])
+    return tables
+
+
+def routing_tables_dir(routing_dir, key):
+    """Return the directory in routing_dir with the routing tables for the key.
+
+    Every host has its own subdirectory, as routing_dir can be shared.
+    The current symlink in it points to the last saved tables.
+    Returns None if they aren't the ones for the key.
+    """
+    current = os.path.join(routing_dir, MPI.Get_processor_name(), "current")
+    try:
+        with open(os.path.join(current, "key.json")) as fobj:
+            if json.load(fobj)["key"] != key:
+                return None
+    except FileNotFoundError:
+        return None
+    return os.path.realpath(current)
+
+
+def update_routing_tables_dir(table_dir):
+    """Make the routing tables saved to the directory the current ones of the host.
+
+    The current symlink is replaced atomically,
+    so readers see either the old or the new tables in full.
+    The old tables are removed.
+    """
+    host_dir = os.path.dirname(table_dir)
+    current = os.path.join(host_dir, "current")
+    old_dir = os.path.realpath(current) if os.path.islink(current) else None
+
+    link = "%s.%d" % (current, os.getpid())
+    os.symlink(os.path.basename(table_dir), link)
+    os.replace(link, current)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def shared_routing_tables(
+    lid_part_file, pid_part_file, per_node_behavior, routing_dir, shm_dir
+):
+    """Return the rank lookups, shared by all the ranks on the node.
+
+    The first rank on the node saves the lookups in routing_dir,
+    unless they are already there for the same partition files and rank layout;
+    then every rank on the node memory maps them read only.
+    The lookups are always saved to a new directory,
+    so nothing of the ones saved before is ever mixed in.
+    Without a routing_dir they are saved to a temporary directory in shm_dir,
+    which is removed once mapped.
+    """
+    node_comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+    is_temp = node_comm.Get_rank() == 0 and routing_dir is None
+    table_dir = None
+
+    try:
+        if node_comm.Get_rank() == 0:
+            key = routing_tables_key(lid_part_file, pid_part_file, per_node_behavior)
+            if not is_temp:
+                table_dir = routing_tables_dir(routing_dir, key)
+
+            if table_dir is None:
+                with timing("ConfigActor:build_routing_tables"):
+                    if is_temp:
+                        table_dir = tempfile.mkdtemp(
+                            prefix="pansim-routing-", dir=shm_dir
+                        )
+                    else:
+                        host_dir = os.path.join(routing_dir, MPI.Get_processor_name())
+                        os.makedirs(host_dir, exist_ok=True)
+                        table_dir = tempfile.mkdtemp(prefix="tables-", dir=host_dir)
+
+                    tables = build_routing_tables(
+                        lid_part_file, pid_part_file, per_node_behavior
+                    )
+                    save_routing_tables(tables, table_dir, key)
+                    if not is_temp:
+                        update_routing_tables_dir(table_dir)
+            node_comm.bcast(table_dir)
+        else:
+            table_dir = node_comm.bcast(None)
+
+        tables = load_routing_tables(table_dir)
+
+        node_comm.Barrier()
+    finally:
+        # The temporary directory is removed even if building or mapping fails
+        if is_temp and table_dir is not None:
+            shutil.rmtree(table_dir, ignore_errors=True)
+        node_comm.Free()
+
+    return tables
+
+
 class ConfigActor:
     """Configuration actor."""
 
     def __init__(self, per_node_behavior, java_behavior):
         """Initialize."""
+        start = time.perf_counter()
         nodes = list(asys.nodes())
         current_rank = asys.current_rank()
         current_node = [node for node in nodes if current_rank in asys.node_ranks(node)]
         current_node = current_node[0]
         current_node_index = nodes.index(current_node)
         os.environ["CURRENT_NODE"] = str(current_node_index)
+        self.node_ranks = asys.node_ranks(current_node)
 
         self.per_node_behavior = per_node_behavior
         self.java_behavior = java_behavior
 
         self.seed = int(os.environ["SEED"])
         self.tick_time = int(os.environ["TICK_TIME"])
+        self.num_ticks = int(os.environ["NUM_TICKS"])
         self.attr_names = os.environ["VISUAL_ATTRIBUTES"].strip().split(",")
 
-        self.disease_model = DiseaseModel(os.environ["DISEASE_MODEL_FILE"])
-
-        self.visit_schema = make_visit_schema(self.attr_names)
-        self.visit_output_schema = make_visit_output_schema(self.attr_names)
-        self.state_schema = make_state_schema()
-
-        self.empty_visit_df = self.visit_schema.empty_table().to_pandas()
-        self.empty_visit_output_df = self.visit_output_schema.empty_table().to_pandas()
-        self.empty_state_df = self.state_schema.empty_table().to_pandas()
-
-        lid_part_file = os.environ["LID_PARTITION"]
-        pid_part_file = os.environ["PID_PARTITION"]
+        self.transmission_mode = os.environ.get("TRANSMISSION_MODE", "pairwise")
+        self.accumulation_mode = os.environ.get("ACCUMULATION_MODE", "prob")
+        self.num_threads = int(os.environ.get("NUM_THREADS", "1"))
+        self.visit_backend = os.environ.get("VISIT_BACKEND", "auto")
+
+        self.exchange_mode = os.environ.get("EXCHANGE_MODE", "actor")
+        if self.exchange_mode not in EXCHANGE_MODES:
+            raise ValueError("Unknown exchange mode: %r" % self.exchange_mode)
+        if self.exchange_mode == "collective":
+            self.exchange_comm = MPI.COMM_WORLD.Dup()
+
+        # Ticks are pipelined by letting the behavior actors start the next tick
+        self.pipeline = bool(int(os.environ.get("PIPELINE", "0")))
+        if self.pipeline and self.exchange_mode == "collective":
+            raise ValueError("Pipelined ticks need the actor exchange mode")
+
+        # The visit outputs of a location rank are streamed in chunks
+        self.visit_output_chunks = int(os.environ.get("VISIT_OUTPUT_CHUNKS", "1"))
+        if self.visit_output_chunks < 1:
+            raise ValueError("VISIT_OUTPUT_CHUNKS must be at least 1")
+        if self.visit_output_chunks > 1 and self.exchange_mode == "collective":
+            raise ValueError("Streamed visit outputs need the actor exchange mode")
+
+        # Large batches to other nodes are compressed with lz4 or zstd
+        self.ipc_compression = os.environ.get("IPC_COMPRESSION", "none")
+        if self.ipc_compression not in IPC_COMPRESSIONS:
+            raise ValueError("Unknown IPC compression: %r" % self.ipc_compression)
+        self.ipc_compression_threshold = int(
+            os.environ.get("IPC_COMPRESSION_THRESHOLD", "65536")
+        )
 
-        lid_part_df = pd.read_csv(lid_part_file)
-        pid_part_df = pd.read_csv(pid_part_file)
+        # Batches to other ranks on the same node go through shared memory files,
+        # only the file names are sent over MPI
+        self.shm_transport = bool(int(os.environ.get("SHM_TRANSPORT", "0")))
+        self.shm_dir = os.environ.get("SHM_DIR", "/dev/shm")
+        if self.shm_transport and self.exchange_mode == "actor":
+            self.shm_ranks = set(self.node_ranks) - {current_rank}
+        else:
+            self.shm_ranks = set()
+
+        self.disease_model = DiseaseModel(
+            os.environ["DISEASE_MODEL_FILE"],
+            transmission_mode=self.transmission_mode,
+            accumulation_mode=self.accumulation_mode,
+            num_threads=self.num_threads,
+            visit_backend=self.visit_backend,
+            seed=self.seed,
+        )
 
-        self.lid_rank = {}
-        for lid, node, cpu in lid_part_df.itertuples(index=False, name=None):
-            self.lid_rank[lid] = node_rank(node, cpu)
+        # The ids can be sent as int32 if they have been remapped with remapids,
+        # and the visit outputs with compact dtypes
+        self.id_type = os.environ.get("ID_TYPE", "int64")
+        self.compact_dtypes = bool(int(os.environ.get("COMPACT_DTYPES", "0")))
+
+        self.visit_schema = make_visit_schema(self.attr_names, self.id_type)
+        self.visit_output_schema = make_visit_output_schema(
+            self.attr_names,
+            log_survival=self.accumulation_mode == "log_survival",
+            id_type=self.id_type,
+            compact=self.compact_dtypes,
+        )
+        self.state_schema = make_state_schema(self.id_type)
+        self.state_delta_schema = make_state_delta_schema(self.id_type)
 
-        self.pid_prog_rank = {}
-        self.pid_behav_rank = {}
-        for pid, node, cpu in pid_part_df.itertuples(index=False, name=None):
-            self.pid_prog_rank[pid] = node_rank(node, cpu)
-            if per_node_behavior:
-                self.pid_behav_rank[pid] = node_rank(node, 0)
-            else:
-                self.pid_behav_rank[pid] = node_rank(node, cpu)
+        # Visit outputs are sent on combined per person
+        # if that is all the behavior model needs
+        if java_behavior:
+            self.behavior_model_cls = SimpleJavaBehaviorModel
+        else:
+            self.behavior_model_cls = SimpleBehaviorModel
+        self.combine_visit_outputs = (
+            self.behavior_model_cls.visit_output_level == "person"
+        )
+        self.visit_output_aggregation = self.behavior_model_cls.visit_output_aggregation
+
+        # Only the visit output columns the behavior model uses are sent to it,
+        # and none at all if it uses none
+        columns = self.behavior_model_cls.visit_output_columns
+        if columns is None:
+            columns = self.visit_output_schema.names
+        for col in columns:
+            if col not in self.visit_output_schema.names:
+                raise ValueError("Behavior model uses unknown visit output: %r" % col)
+        self.behavior_visit_output_schema = pa.schema(
+            [self.visit_output_schema.field(col) for col in columns]
+        )
+        self.send_visit_outputs = bool(columns)
+
+        # The routing tables are built once per node,
+        # or once for all runs if ROUTING_DIR is given
+        tables = shared_routing_tables(
+            os.environ["LID_PARTITION"],
+            os.environ["PID_PARTITION"],
+            per_node_behavior,
+            os.environ.get("ROUTING_DIR") or None,
+            self.shm_dir,
+        )
+        self.lid_rank = tables["lid_rank"]
+        self.pid_prog_rank = tables["pid_prog_rank"]
+        self.pid_behav_rank = tables["pid_behav_rank"]
 
         if per_node_behavior:
             self.behav_ranks = [asys.node_ranks(node)[0] for node in asys.nodes()]
         else:
             self.behav_ranks = asys.ranks()
 
+        report_ready(CONFIG_AID, start)
+
 
 class MainActor:
     """Main Actor."""
@@ -446,8 +919,18 @@ class MainActor:
         self.java_behavior = int(os.environ.get("JAVA_BEHAVIOR", "0"))
         if self.java_behavior:
             self.per_node_behavior = True
-
-        self.epicurve_parts = []
+        self.exchange_mode = os.environ.get("EXCHANGE_MODE", "actor")
+        self.pipeline = bool(int(os.environ.get("PIPELINE", "0")))
+
+        self.n_actors = 0
+        self.n_ready = 0
+        self.ready_time = {}
+
+        # In the pipelined mode the parts of later ticks
+        # can arrive before the current tick has ended
+        self.epicurve_parts = defaultdict(list)
+        self.needs_every_tick = defaultdict(list)
+        self.progression_statuses = defaultdict(list)
         self.cur_tick = 0
 
         self.tick_epicurve = []
@@ -457,8 +940,15 @@ class MainActor:
         else:
             self.behav_ranks = asys.ranks()
 
+        # With the collective exchange every rank starts the tick
+        if self.exchange_mode == "collective":
+            self.start_ranks = asys.ranks()
+        else:
+            self.start_ranks = self.behav_ranks
+
     def main(self):
         """Run the simulation."""
+        # The first tick is started once all the actors report they are ready
         with timing("MainActor:actor_creation"):
             for rank in asys.ranks():
                 asys.create_actor(
@@ -470,45 +960,106 @@ class MainActor:
                 )
                 asys.create_actor(rank, LOC_AID, LocationActor)
                 asys.create_actor(rank, PROG_AID, ProgressionActor)
+                self.n_actors += 3
 
-            for rank in self.behav_ranks:
-                asys.create_actor(rank, BEHAV_AID, BehaviorActor)
+            for rank in asys.ranks():
+                if rank in self.behav_ranks:
+                    asys.create_actor(rank, BEHAV_AID, BehaviorActor)
+                    self.n_actors += 1
+                elif self.exchange_mode == "collective":
+                    asys.create_actor(rank, BEHAV_AID, IdleBehaviorActor)
+                    self.n_actors += 1
+
+    def actor_ready(self, rank, actor_id, start, duration):
+        """Receive the ready message of an actor."""
+        LOG.info(
+            "#ready# rank=%d actor=%s start=%f duration=%f",
+            rank,
+            actor_id,
+            start,
+            duration,
+        )
+        self.ready_time[rank] = self.ready_time.get(rank, 0.0) + duration
+        self.n_ready += 1
+        if self.n_ready < self.n_actors:
+            return
 
-            time.sleep(30)
+        slowest = max(self.ready_time, key=self.ready_time.get)
+        LOG.info(
+            "MainActor: All actors ready at %f; slowest rank %d took %f",
+            time.perf_counter() - PROCESS_START_TIME,
+            slowest,
+            self.ready_time[slowest],
+        )
+        self.start_tick()
 
+    def start_tick(self):
+        """Start the current tick on all ranks."""
         LOG.info(
             "MainActor: Starting tick %d at %f",
             self.cur_tick,
             time.perf_counter() - PROCESS_START_TIME,
         )
-        for rank in self.behav_ranks:
+        for rank in self.start_ranks:
             asys.ActorProxy(rank, BEHAV_AID).start_tick()
 
-    def end_tick(self, epicurve_part):
+    def end_tick(self, tick, epicurve_part, needs_every_tick):
         """Receive the end tick message."""
         LOG.debug("MainActor: Received end_tick")
 
-        self.epicurve_parts.append(epicurve_part)
-
-        # Check if tick ended
-        if len(self.epicurve_parts) < len(self.behav_ranks):
-            return
-
-        row = [sum(xs) for xs in zip(*self.epicurve_parts)]
-        self.tick_epicurve.append(row)
-        self.cur_tick += 1
-        self.epicurve_parts = []
-
-        # Check if sim should still be running
-        if self.cur_tick < self.num_ticks:
-            LOG.info(
-                "MainActor: Starting tick %d at %f",
-                self.cur_tick,
-                time.perf_counter() - PROCESS_START_TIME,
-            )
-            for rank in self.behav_ranks:
-                asys.ActorProxy(rank, BEHAV_AID).start_tick()
-            return
+        self.epicurve_parts[tick].append(epicurve_part)
+        self.needs_every_tick[tick].append(needs_every_tick)
+        self.try_end_tick()
+
+    def progression_status(self, tick, n_infectious, n_pending):
+        """Receive the progression status of a rank."""
+        LOG.debug("MainActor: Received progression_status")
+
+        self.progression_statuses[tick].append((n_infectious, n_pending))
+        self.try_end_tick()
+
+    def try_end_tick(self):
+        """End the ticks all the ranks are done with."""
+        while self.cur_tick < self.num_ticks:
+            # Check if tick ended
+            tick = self.cur_tick
+            if len(self.epicurve_parts[tick]) < len(self.behav_ranks):
+                return
+            if len(self.progression_statuses[tick]) < len(asys.ranks()):
+                return
+
+            epicurve_parts = self.epicurve_parts.pop(tick)
+            needs_every_tick = self.needs_every_tick.pop(tick)
+            progression_statuses = self.progression_statuses.pop(tick)
+
+            row = [sum(xs) for xs in zip(*epicurve_parts)]
+            self.tick_epicurve.append(row)
+            self.cur_tick += 1
+
+            # If no one is infectious and no one is pending processing
+            # the remaining epicurve rows will be the same.
+            # The pipelined ticks are already running, so they are not skipped.
+            n_infectious, n_pending = [sum(xs) for xs in zip(*progression_statuses)]
+            if (
+                not self.pipeline
+                and not any(needs_every_tick)
+                and n_infectious == 0
+                and n_pending == 0
+            ):
+                if self.cur_tick < self.num_ticks:
+                    LOG.info(
+                        "MainActor: Nothing can change anymore, "
+                        "skipping ticks %d to %d",
+                        self.cur_tick,
+                        self.num_ticks - 1,
+                    )
+                self.tick_epicurve.extend([row] * (self.num_ticks - self.cur_tick))
+                self.cur_tick = self.num_ticks
+
+            # Check if sim should still be running
+            if self.cur_tick < self.num_ticks and not self.pipeline:
+                self.start_tick()
+                return
 
         with timing("MainActor:writing_out_epicurve"):
             # Sim has now ended
@@ -0,0 +1,170 @@
+"""Columnar state of the persons owned by a rank."""
+
+import numpy as np
+
+from .data_schema import has_column, column_to_numpy
+from .disease_model import NULL_DWELL_TIME
+from .timing_wheel import TimingWheel
+
+STATE_COLUMNS = ["pid", "group", "current_state", "next_state", "dwell_time", "seed"]
+
+
+class PersonState:
+    """Persistent state of a fixed set of persons.
+
+    Every column is a numpy array indexed by the local index of a person,
+    which is the position of the pid in the sorted pid array.
+
+    The dwell times are not decremented every tick.
+    The dwell_time column holds the dwell time left
+    at the end of tick dwell_tick,
+    and every person is scheduled on the timing wheel
+    at the next tick it needs to be processed at (touch_tick).
+    """
+
+    def __init__(self, pids, tick_time):
+        """Initialize."""
+        self.pid = np.unique(np.asarray(pids, dtype=np.int64))
+        self.tick_time = tick_time
+
+        n = len(self.pid)
+        self.group = np.zeros(n, dtype=np.int64)
+        self.current_state = np.zeros(n, dtype=np.int64)
+        self.next_state = np.zeros(n, dtype=np.int64)
+        self.dwell_time = np.zeros(n, dtype=np.int64)
+        self.seed = np.zeros(n, dtype=np.int64)
+
+        self.dwell_tick = np.zeros(n, dtype=np.int64)
+        self.touch_tick = np.full(n, -1, dtype=np.int64)
+        self.loaded = np.zeros(n, dtype=bool)
+        self.wheel = TimingWheel()
+
+    def __len__(self):
+        """Return the number of persons."""
+        return len(self.pid)
+
+    def local_index(self, pid):
+        """Return the local index of the given pids."""
+        pid = np.asarray(pid, dtype=np.int64)
+        idx = np.searchsorted(self.pid, pid)
+        idx = np.minimum(idx, len(self.pid) - 1)
+        if len(pid) and (len(self.pid) == 0 or np.any(self.pid[idx] != pid)):
+            raise ValueError("State has no row for some of the given pids.")
+        return idx
+
+    def dwell_time_left(self, idx, tick):
+        """Return the dwell time left at the end of the tick."""
+        dwell_time = self.dwell_time[idx]
+        elapsed = (tick - self.dwell_tick[idx]) * self.tick_time
+        return np.where(
+            dwell_time == NULL_DWELL_TIME,
+            NULL_DWELL_TIME,
+            np.maximum(dwell_time - elapsed, 0),
+        )
+
+    def schedule(self, idx, touch_tick):
+        """Schedule the persons to be processed at the given ticks.
+
+        A touch_tick of -1 means the person doesn't need processing.
+        """
+        self.touch_tick[idx] = touch_tick
+        keep = touch_tick >= 0
+        self.wheel.schedule(idx[keep], touch_tick[keep])
+
+    def pop_due(self, tick):
+        """Return the sorted local indices of the persons due at the tick."""
+        idx = self.wheel.pop(tick)
+        return idx[self.touch_tick[idx] == tick]
+
+    def diff(self, state_df, tick):
+        """Compare the state received before the tick with the stored state.
+
+        The state can be a pandas dataframe or an arrow table.
+        Returns the local indices of the given persons, their columns,
+        and whether the state of each differs from the stored state
+        at the end of the previous tick.
+        """
+        idx = self.local_index(column_to_numpy(state_df, "pid"))
+        cols = {col: column_to_numpy(state_df, col) for col in STATE_COLUMNS[1:]}
+
+        changed = ~self.loaded[idx]
+        changed |= self.dwell_time_left(idx, tick - 1) != cols["dwell_time"]
+        for col in ["group", "current_state", "next_state", "seed"]:
+            changed |= getattr(self, col)[idx] != cols[col]
+
+        return idx, cols, changed
+
+    def update(self, state_df, tick):
+        """Update the state with the state received before the tick.
+
+        Only the persons whose state differs from the one
+        sent out at the end of the previous tick are overwritten
+        and rescheduled.
+        """
+        idx, cols, changed = self.diff(state_df, tick)
+        idx = idx[changed]
+        for col, values in cols.items():
+            getattr(self, col)[idx] = values[changed]
+        self.dwell_tick[idx] = tick - 1
+        self.loaded[idx] = True
+
+        # Persons in transition are next processed when the dwell time runs out,
+        # the others are processed at this tick
+        dwell_time = self.dwell_time[idx]
+        n_ticks = -(-np.maximum(dwell_time, 0) // self.tick_time)
+        touch_tick = np.where(dwell_time == NULL_DWELL_TIME, tick, tick + n_ticks)
+        self.schedule(idx, touch_tick)
+
+    def columns(self, idx, tick):
+        """Return the state columns at the end of the tick of the given local indices."""
+        columns = {col: getattr(self, col)[idx] for col in STATE_COLUMNS}
+        columns["dwell_time"] = self.dwell_time_left(idx, tick)
+        return columns
+
+    def delta(self, idx):
+        """Return the stored columns of the given local indices.
+
+        The dwell times are returned as is, along with their dwell_tick,
+        so a delta stays valid on the ticks after it was made.
+        """
+        columns = {col: getattr(self, col)[idx] for col in STATE_COLUMNS}
+        columns["dwell_tick"] = self.dwell_tick[idx]
+        return columns
+
+    def apply_delta(self, delta):
+        """Overwrite the stored columns with a delta made by another state.
+
+        The delta can be a pandas dataframe or an arrow table.
+        The persons are not scheduled;
+        this is used to mirror the state owned by another rank.
+        """
+        idx = self.local_index(column_to_numpy(delta, "pid"))
+        for col in STATE_COLUMNS[1:] + ["dwell_tick"]:
+            getattr(self, col)[idx] = column_to_numpy(delta, col)
+        self.loaded[idx] = True
+
+    def reduce_visit_outputs(self, visit_outputs):
+        """Compute the cumulative infection probability of every visiting person.
+
+        The visit outputs can be a pandas dataframe or an arrow table.
+        Returns the sorted local indices of the persons with visits
+        and their infection probabilities.
+        """
+        v_idx = self.local_index(column_to_numpy(visit_outputs, "pid"))
+        order = np.argsort(v_idx, kind="stable")
+        v_idx = v_idx[order]
+        starts = np.flatnonzero(np.diff(v_idx, prepend=-1))
+        idx = v_idx[starts]
+        if len(idx) == 0:
+            return idx, np.zeros(0, dtype=np.float64)
+
+        if has_column(visit_outputs, "log_survival"):
+            log_survival = column_to_numpy(visit_outputs, "log_survival", np.float64)
+            log_survival = np.add.reduceat(log_survival[order], starts)
+            inf_p = -np.expm1(log_survival)
+        else:
+            survival = 1.0 - column_to_numpy(visit_outputs, "inf_prob", np.float64)
+            survival = np.multiply.reduceat(survival[order], starts)
+            inf_p = 1.0 - survival
+
+        return idx, inf_p
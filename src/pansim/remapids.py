@@ -0,0 +1,103 @@
+"""Remap the person and location ids to dense integers."""
+
+import os
+
+import click
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as csv
+
+
+def remap(table, col, ids, fname):
+    """Replace the ids in the column with their index in the sorted ids."""
+    old = table.column(col).to_numpy()
+    new = np.searchsorted(ids, old)
+    new = np.minimum(new, len(ids) - 1)
+    if len(old) and (len(ids) == 0 or np.any(ids[new] != old)):
+        raise ValueError(f"{fname}: some {col}s are not in the partition")
+
+    i_col = table.schema.get_field_index(col)
+    return table.set_column(i_col, col, pa.array(new, type=pa.int32()))
+
+
+def remap_file(fname, output_dir, id_cols):
+    """Write a copy of the csv file with the ids remapped to the output directory."""
+    table = csv.read_csv(fname)
+    for col, ids in id_cols.items():
+        table = remap(table, col, ids, fname)
+
+    out_fname = os.path.join(output_dir, os.path.basename(fname))
+    csv.write_csv(table, out_fname)
+    return out_fname
+
+
+def write_id_map(ids, fname):
+    """Write the mapping of the new ids to the original ids."""
+    table = pa.table(
+        {"id": np.arange(len(ids), dtype=np.int32), "orig_id": ids},
+    )
+    csv.write_csv(table, fname)
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--start-state",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, file_okay=True),
+    help="The start state file.",
+)
+@click.option(
+    "-v",
+    "--visit-file",
+    "visit_files",
+    multiple=True,
+    type=click.Path(exists=True, dir_okay=False, file_okay=True),
+    help="A visit file; can be given multiple times.",
+)
+@click.option(
+    "-l",
+    "--lid-partition",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, file_okay=True),
+    help="The location partition file.",
+)
+@click.option(
+    "-p",
+    "--pid-partition",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, file_okay=True),
+    help="The person partition file.",
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    required=True,
+    type=click.Path(exists=False, dir_okay=True, file_okay=False),
+    help="The directory to write the remapped files to.",
+)
+def remapids(start_state, visit_files, lid_partition, pid_partition, output_dir):
+    """Remap the person and location ids to dense int32 indices.
+
+    The new id of a person or location is its index
+    in the sorted ids of the partition file.
+    The remapped copies of the files are written to the output directory,
+    along with pid_map.csv and lid_map.csv giving the original ids.
+    The simulation can then be run with ID_TYPE=int32.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    pids = np.unique(csv.read_csv(pid_partition).column("pid").to_numpy())
+    lids = np.unique(csv.read_csv(lid_partition).column("lid").to_numpy())
+    if max(len(pids), len(lids)) > np.iinfo(np.int32).max:
+        raise ValueError("Too many ids to remap to int32")
+
+    print("Remapping %d pids and %d lids" % (len(pids), len(lids)))
+    remap_file(pid_partition, output_dir, {"pid": pids})
+    remap_file(lid_partition, output_dir, {"lid": lids})
+    remap_file(start_state, output_dir, {"pid": pids})
+    for fname in visit_files:
+        remap_file(fname, output_dir, {"lid": lids, "pid": pids})
+
+    write_id_map(pids, os.path.join(output_dir, "pid_map.csv"))
+    write_id_map(lids, os.path.join(output_dir, "lid_map.csv"))
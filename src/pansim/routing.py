@@ -0,0 +1,144 @@
+"""Routing of table rows to ranks."""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Ids are looked up in a dense array if it isn't much larger than the id set
+DENSE_FACTOR = 4
+DENSE_MIN = 1 << 16
+
+
+def compact_ids(ids):
+    """Return the ids as int32 if they fit, else as int64."""
+    ids = np.asarray(ids, dtype=np.int64)
+    info = np.iinfo(np.int32)
+    if len(ids) and (ids.min() < info.min or ids.max() > info.max):
+        return ids
+    return ids.astype(np.int32)
+
+
+class RankLookup:
+    """Map ids to ranks using dense numpy lookup arrays.
+
+    If the ids are small non negative integers,
+    the rank of id i is simply rank[i].
+    Otherwise the ids are first remapped to their position
+    in the sorted id array.
+    The ids are kept as int32 when they fit, and the ranks always are.
+    """
+
+    def __init__(self, ids, ranks):
+        """Initialize."""
+        self.all_ids = compact_ids(ids)
+        self.all_ranks = np.asarray(ranks, dtype=np.int32)
+
+        n = len(self.all_ids)
+        if n == 0 or (
+            self.all_ids.min() >= 0
+            and self.all_ids.max() < DENSE_FACTOR * n + DENSE_MIN
+        ):
+            self.ids = None
+            size = int(self.all_ids.max()) + 1 if n else 0
+            self.rank = np.full(size, -1, dtype=np.int32)
+            self.rank[self.all_ids] = self.all_ranks
+        else:
+            order = np.argsort(self.all_ids, kind="stable")
+            self.ids = self.all_ids[order]
+            self.rank = self.all_ranks[order]
+
+    def lookup(self, ids):
+        """Return the ranks of the given ids."""
+        ids = np.asarray(ids)
+        if self.ids is None:
+            idx = ids
+            valid = (ids >= 0) & (ids < len(self.rank))
+        else:
+            idx = np.searchsorted(self.ids, ids)
+            valid = idx < len(self.ids)
+            valid[valid] = self.ids[idx[valid]] == ids[valid]
+
+        if not valid.all():
+            raise ValueError("Some of the ids have no rank assigned.")
+        ranks = self.rank[idx]
+        if len(ranks) and ranks.min() < 0:
+            raise ValueError("Some of the ids have no rank assigned.")
+        return ranks
+
+    @property
+    def mode(self):
+        """Return how the ids are looked up; "dense" or "sorted"."""
+        return "dense" if self.ids is None else "sorted"
+
+    def ids_of(self, rank):
+        """Return the ids assigned to the rank."""
+        return self.all_ids[self.all_ranks == rank]
+
+    def save(self, prefix):
+        """Save the lookup arrays to .npy files starting with the given prefix."""
+        np.save(prefix + "_all_ids.npy", self.all_ids)
+        np.save(prefix + "_all_ranks.npy", self.all_ranks)
+        np.save(prefix + "_rank.npy", self.rank)
+        if self.ids is not None:
+            np.save(prefix + "_ids.npy", self.ids)
+
+    @classmethod
+    def load(cls, prefix, mode):
+        """Memory map the lookup arrays saved with the given prefix read only.
+
+        The mode is the one of the saved lookup.
+        """
+        if mode not in ("dense", "sorted"):
+            raise ValueError("Unknown rank lookup mode: %r" % mode)
+
+        lookup = cls.__new__(cls)
+        lookup.all_ids = np.load(prefix + "_all_ids.npy", mmap_mode="r")
+        lookup.all_ranks = np.load(prefix + "_all_ranks.npy", mmap_mode="r")
+        lookup.rank = np.load(prefix + "_rank.npy", mmap_mode="r")
+        if mode == "sorted":
+            lookup.ids = np.load(prefix + "_ids.npy", mmap_mode="r")
+        else:
+            lookup.ids = None
+        return lookup
+
+
+class Router:
+    """Split rows into per rank groups, caching the permutations.
+
+    The permutation of a key column is cached by the digest of its content,
+    so a row set that comes back (such as the visits of a visit file)
+    is routed without looking up or sorting the ids again.
+    """
+
+    def __init__(self, lookup, max_cached=16):
+        """Initialize."""
+        self.lookup = lookup
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+
+    def split(self, ids):
+        """Return the row order, the destination ranks, and their row ranges.
+
+        The rows of ranks[i] are order[starts[i]:starts[i] + counts[i]].
+        The order is None if the rows are already grouped by rank.
+        """
+        ids = np.ascontiguousarray(ids)
+        digest = hashlib.blake2b(ids.view(np.uint8), digest_size=16).digest()
+        key = (ids.dtype.str, len(ids), digest)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        ranks = self.lookup.lookup(ids)
+        if np.all(ranks[:-1] <= ranks[1:]):
+            order = None
+        else:
+            order = np.argsort(ranks, kind="stable")
+            ranks = ranks[order]
+        uniq, starts, counts = np.unique(ranks, return_index=True, return_counts=True)
+
+        self.cache[key] = (order, uniq, starts, counts)
+        if len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+        return self.cache[key]
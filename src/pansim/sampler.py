@@ -1,10 +1,14 @@
-"""Samplers for probability distributions."""
+"""Samplers for probability distributions.
+
+Every sampler takes an explicit random number generator;
+either a numpy.random.Generator
+or an AgentRandom drawing one value for every agent.
+"""
 
 
 from math import isclose
 
-from vose_sampler import VoseAlias
-from numpy.random import gamma
+import numpy as np
 
 
 class FixedSampler:
@@ -14,12 +18,46 @@ class FixedSampler:
         """Initialize."""
         self.val = val
 
-    def sample(self):
+    def sample(self, rng):
         """Return a sample from the distribution."""
         return self.val
 
+    def sample_many(self, n, rng):
+        """Return n samples from the distribution."""
+        return np.full(n, self.val)
+
+
+def make_alias_table(probs):
+    """Return the Vose alias method tables of the given probabilities.
+
+    Returns the probability of keeping every column
+    and the index of the alias of every column.
+    """
+    n = len(probs)
+    scaled = np.asarray(probs, dtype=np.float64) * n
+    prob = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        i_small = small.pop()
+        i_large = large.pop()
+
+        prob[i_small] = scaled[i_small]
+        alias[i_small] = i_large
+
+        scaled[i_large] = (scaled[i_large] + scaled[i_small]) - 1.0
+        if scaled[i_large] < 1.0:
+            small.append(i_large)
+        else:
+            large.append(i_large)
 
-class CategoricalSampler(VoseAlias):
+    # Whatever remains has probability one up to rounding errors
+    return prob, alias
+
+
+class CategoricalSampler:
     """A sampler that returns a value from a categorical distribution."""
 
     def __init__(self, dist):
@@ -27,11 +65,23 @@ class CategoricalSampler(VoseAlias):
         if not isclose(sum(dist.values()), 1.0):
             raise ValueError("Probabilities in the distribution dont add up to 1")
 
-        super().__init__(dist)
+        self.values = np.array(list(dist.keys()))
+        self.prob, self.alias = make_alias_table(list(dist.values()))
 
-    def sample(self):
+    def sample(self, rng):
         """Return a sample from the distribution."""
-        return self.alias_generation()
+        return self.sample_many(1, rng)[0]
+
+    def sample_many(self, n, rng):
+        """Return n samples from the distribution.
+
+        One uniform number picks both the column and the coin toss.
+        """
+        u = rng.random(n) * len(self.values)
+        col = np.minimum(u.astype(np.int64), len(self.values) - 1)
+        keep = (u - col) < self.prob[col]
+        return self.values[np.where(keep, col, self.alias[col])]
+
 
 class GammaDistributionSampler:
     """A sampler that returns a value from a gamma distribution"""
@@ -40,5 +90,10 @@ class GammaDistributionSampler:
         self.shape = shape
         self.scale = scale
 
-    def sample(self):
-        return round(gamma(self.shape, self.scale))
+    def sample(self, rng):
+        """Return a sample from the distribution."""
+        return self.sample_many(1, rng)[0]
+
+    def sample_many(self, n, rng):
+        """Return n samples from the distribution."""
+        return np.round(rng.gamma(self.shape, self.scale, n)).astype(np.int64)
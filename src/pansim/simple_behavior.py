@@ -4,6 +4,7 @@ import os
 import random
 from itertools import count
 
+import numpy as np
 import pyarrow.csv as csv
 
 from .disease_model import SEED_MIN, SEED_MAX, NULL_STATE, NULL_DWELL_TIME
@@ -22,29 +23,36 @@ def read_start_state_df(fname, seed):
 
     return start_state_df
 
-def setup_visit_df(visit_df, state_df, attr_names):
-    """Return the visit dataframe."""
+def prepare_visit_df(visit_df, attr_names):
+    """Return the visit dataframe without the state dependent columns."""
     visit_df = visit_df.copy()
     visit_df["behavior"] = 0
     for name in attr_names:
         visit_df[name] = 0
 
-    pid_i = {pid: i for i, pid in enumerate(state_df.pid)}
-    i_current_state = list(state_df.current_state)
-    i_group = list(state_df.group)
+    return visit_df
+
+def fill_visit_state(visit_df, state_df):
+    """Fill in the state dependent columns of a prepared visit dataframe."""
+    state_pid = state_df.pid.to_numpy()
+    visit_pid = visit_df.pid.to_numpy()
 
-    state_col = []
-    group_col = []
-    for pid in visit_df.pid:
-        i = pid_i[pid]
-        state_col.append(i_current_state[i])
-        group_col.append(i_group[i])
+    order = np.argsort(state_pid, kind="stable")
+    i = np.searchsorted(state_pid, visit_pid, sorter=order)
+    i = order[np.minimum(i, len(order) - 1)]
+    if len(visit_pid) and (len(state_pid) == 0 or np.any(state_pid[i] != visit_pid)):
+        raise ValueError("State has no row for some of the visiting pids.")
 
-    visit_df["state"] = state_col
-    visit_df["group"] = group_col
+    visit_df["state"] = state_df.current_state.to_numpy()[i]
+    visit_df["group"] = state_df.group.to_numpy()[i]
 
     return visit_df
 
+def setup_visit_df(visit_df, state_df, attr_names):
+    """Return the visit dataframe."""
+    visit_df = prepare_visit_df(visit_df, attr_names)
+    return fill_visit_state(visit_df, state_df)
+
 def subset_pid(df, pids):
     """Get the subset of the dataframe for given pids."""
     df = df[df.pid.isin(pids)]
@@ -56,6 +64,16 @@ def subset_pid(df, pids):
 class SimpleBehaviorModel:
     """Simple behavior model."""
 
+    # The model doesn't change the state,
+    # so the ticks after the epidemic has died out can be skipped
+    needs_every_tick = False
+
+    # The model doesn't use the visit outputs,
+    # so they aren't sent to it and can be combined per person
+    visit_output_columns = []
+    visit_output_level = "person"
+    visit_output_aggregation = {}
+
     def __init__(self, seed=None, pids=None):
         """Initialize."""
         if seed is None:
@@ -88,11 +106,23 @@ class SimpleBehaviorModel:
                 self.visit_dfs_raw[i] = subset_pid(self.visit_dfs_raw[i], pids)
 
         self.next_tick = 0
+        self.prepared_visit_dfs = {}
 
         self.next_state_df = self.start_state_df
         idx = self.next_tick % len(self.visit_dfs_raw)
         self.next_visit_df = setup_visit_df(self.visit_dfs_raw[idx], self.start_state_df, self.attr_names)
 
+    def prepare_tick(self, tick):
+        """Prepare the visits of the tick that don't depend on the state.
+
+        Can be called ahead of time, while the previous tick is running.
+        Returns the prepared visit dataframe.
+        """
+        idx = tick % len(self.visit_dfs_raw)
+        visit_df = prepare_visit_df(self.visit_dfs_raw[idx], self.attr_names)
+        self.prepared_visit_dfs[tick] = visit_df
+        return visit_df
+
     def run_behavior_model(self, cur_state_df, visit_output_df):
         """Run the behavior model."""
         _ = visit_output_df
@@ -100,5 +130,7 @@ class SimpleBehaviorModel:
         self.next_tick += 1
 
         self.next_state_df = cur_state_df
-        idx = self.next_tick % len(self.visit_dfs_raw)
-        self.next_visit_df = setup_visit_df(self.visit_dfs_raw[idx], cur_state_df, self.attr_names)
+        if self.next_tick not in self.prepared_visit_dfs:
+            self.prepare_tick(self.next_tick)
+        visit_df = self.prepared_visit_dfs.pop(self.next_tick)
+        self.next_visit_df = fill_visit_state(visit_df, cur_state_df)
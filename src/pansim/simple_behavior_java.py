@@ -50,12 +50,26 @@ def get_gateway():
 class SimpleJavaBehaviorModel:
     """Simple behavior model."""
 
+    # The java model may change the state in any tick
+    needs_every_tick = True
+
+    # The java model gets all the visit output columns for every visit
+    visit_output_columns = None
+    visit_output_level = "visit"
+    visit_output_aggregation = {}
+
     def __init__(self):
         """Initialize."""
         self.attr_names = os.environ["VISUAL_ATTRIBUTES"].strip().split(",")
         self.gateway = None
-        self.visit_output_schema = make_visit_output_schema(self.attr_names)
-        self.state_schema = make_state_schema()
+        id_type = os.environ.get("ID_TYPE", "int64")
+        self.visit_output_schema = make_visit_output_schema(
+            self.attr_names,
+            log_survival=os.environ.get("ACCUMULATION_MODE") == "log_survival",
+            id_type=id_type,
+            compact=bool(int(os.environ.get("COMPACT_DTYPES", "0"))),
+        )
+        self.state_schema = make_state_schema(id_type)
 
         self.behavior_proc = start_java_behavior()
         self.gateway = get_gateway()
@@ -1,16 +1,14 @@
 """Simple single threaded simulation."""
 
 import os
-from collections import defaultdict
 
-import numpy as np
 import pandas as pd
 import click
-from tqdm import tqdm
 
 from .simple_behavior import SimpleBehaviorModel
 from .simple_behavior_java import SimpleJavaBehaviorModel
 from .disease_model import DiseaseModel
+from .person_state import PersonState
 
 
 @click.command()
@@ -19,10 +17,22 @@ def simplesim():
     num_ticks = int(os.environ["NUM_TICKS"])
     tick_time = int(os.environ["TICK_TIME"])
     output_file = os.environ["OUTPUT_FILE"]
+    seed = int(os.environ["SEED"])
     java_behavior = bool(int(os.environ.get("JAVA_BEHAVIOR", "0")))
+    transmission_mode = os.environ.get("TRANSMISSION_MODE", "pairwise")
+    accumulation_mode = os.environ.get("ACCUMULATION_MODE", "prob")
+    num_threads = int(os.environ.get("NUM_THREADS", "1"))
+    visit_backend = os.environ.get("VISIT_BACKEND", "auto")
 
     print("Loading disease model")
-    disease_model = DiseaseModel(os.environ["DISEASE_MODEL_FILE"])
+    disease_model = DiseaseModel(
+        os.environ["DISEASE_MODEL_FILE"],
+        transmission_mode=transmission_mode,
+        accumulation_mode=accumulation_mode,
+        num_threads=num_threads,
+        visit_backend=visit_backend,
+        seed=seed,
+    )
 
     print("Initializing behavior model")
     if java_behavior:
@@ -31,6 +41,8 @@ def simplesim():
     else:
         behavior_model = SimpleBehaviorModel()
 
+    state = PersonState(behavior_model.next_state_df.pid, tick_time)
+
     epicurve = []
 
     it_1 = range(num_ticks)
@@ -44,40 +56,31 @@ def simplesim():
         epirow = [state_count.get(i, 0) for i in range(disease_model.n_states)]
         epicurve.append(epirow)
 
-        it_2 = visit_df.groupby("lid")
-        it_2 = tqdm(it_2, desc="Transmission step", unit="location")
-        visit_outputs = defaultdict(list)
-        for lid, group in it_2:
-            visit_output = disease_model.compute_visit_output(
-                group, behavior_model.attr_names, lid
-            )
-            for k, v in visit_output.items():
-                visit_outputs[k].append(v)
-        visit_outputs.default_factory = None
-        visit_outputs = {k: np.hstack(vs) for k, vs in visit_outputs.items()}
+        print("Running transmission step")
+        visit_outputs = disease_model.compute_visit_outputs(
+            visit_df, behavior_model.attr_names
+        )
         visit_output_df = pd.DataFrame(visit_outputs)
 
-        state_df = state_df.set_index("pid", drop=False)
-        columns = ["pid", "group", "current_state", "next_state", "dwell_time", "seed"]
-
-        it_3 = visit_output_df.groupby("pid")
-        it_3 = tqdm(it_3, desc="Progression step", unit="person")
-        new_states = []
-        for pid, group in it_3:
-            cur_state = (state_df.at[pid, col] for col in columns)
-            new_state = disease_model.compute_progression_output(
-                cur_state, group, tick_time
-            )
-            new_states.append(new_state)
-        new_state_df = pd.DataFrame(new_states, columns=columns)
+        print("Running progression step")
+        state.update(state_df, tick)
+        p_idx, inf_p = state.reduce_visit_outputs(visit_output_df)
+        disease_model.compute_progression_outputs(state, p_idx, inf_p, tick)
+        new_state_df = pd.DataFrame(state.columns(p_idx, tick))
 
         print("Running behavior model")
         behavior_model.run_behavior_model(new_state_df, visit_output_df)
 
+        if not behavior_model.needs_every_tick:
+            n_infectious, n_pending = disease_model.progression_status(state)
+            if n_infectious == 0 and n_pending == 0:
+                print("Nothing can change anymore, skipping the remaining ticks")
+                break
+
     print("Computing final epicurve.")
     state_count = new_state_df.groupby("current_state").agg({"pid": len}).pid
     epirow = [state_count.get(i, 0) for i in range(disease_model.n_states)]
-    epicurve.append(epirow)
+    epicurve.extend([epirow] * (num_ticks + 1 - len(epicurve)))
 
     print("Saving epicurve")
     epicurve_df = pd.DataFrame(epicurve, columns=disease_model.model_dict["states"])
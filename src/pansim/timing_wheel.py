@@ -0,0 +1,39 @@
+"""Timing wheel for scheduling work on future ticks."""
+
+import numpy as np
+
+
+class TimingWheel:
+    """Lists of local person indices to be processed at given ticks.
+
+    Entries are never removed when a person is rescheduled;
+    the caller filters out the stale entries of a popped tick.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.slots = {}
+
+    def __len__(self):
+        """Return the number of ticks having scheduled entries."""
+        return len(self.slots)
+
+    def schedule(self, idx, ticks):
+        """Schedule the given indices at the given ticks."""
+        idx = np.asarray(idx, dtype=np.int64)
+        ticks = np.asarray(ticks, dtype=np.int64)
+        if len(idx) == 0:
+            return
+
+        order = np.argsort(ticks, kind="stable")
+        uniq, starts = np.unique(ticks[order], return_index=True)
+        for tick, idx_t in zip(uniq, np.split(idx[order], starts[1:])):
+            self.slots.setdefault(int(tick), []).append(idx_t)
+
+    def pop(self, tick):
+        """Remove and return the sorted unique indices scheduled at the tick."""
+        idx = self.slots.pop(tick, [])
+        if not idx:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(idx))
+
@@ -0,0 +1,36 @@
+"""Visit computation backends."""
+
+from .visit_computation_np import (
+    compute_visit_output_batch_np,
+    START_EVENT,
+    END_EVENT,
+    PAIRWISE_TRANSMISSION,
+    CLASS_TRANSMISSION,
+    PROB_ACCUMULATION,
+    LOG_SURVIVAL_ACCUMULATION,
+)
+
+try:
+    from .visit_computation_cy import compute_visit_output_batch_cy
+except ImportError:
+    compute_visit_output_batch_cy = None
+
+# The available backends, in order of preference
+VISIT_BACKENDS = {}
+if compute_visit_output_batch_cy is not None:
+    VISIT_BACKENDS["cython"] = compute_visit_output_batch_cy
+VISIT_BACKENDS["numpy"] = compute_visit_output_batch_np
+
+
+def get_visit_backend(name="auto"):
+    """Return the name and the batch visit computation function of a backend.
+
+    The auto backend is the first available backend in VISIT_BACKENDS.
+    """
+    if name == "auto":
+        name = next(iter(VISIT_BACKENDS))
+    if name not in VISIT_BACKENDS:
+        raise ValueError(
+            "Only visit backends available are: auto, %s" % ", ".join(VISIT_BACKENDS)
+        )
+    return name, VISIT_BACKENDS[name]
@@ -1,30 +1,505 @@
 #cython: infer_types=True
 #cython: language_level=3
 #distutils: language = c++
+#distutils: extra_compile_args = -fopenmp
+#distutils: extra_link_args = -fopenmp
 """Visit computation cython version."""
 
+import numpy as np
+
 from libc.math cimport pow as cpow
-from libcpp.unordered_set cimport unordered_set
-from libcpp.vector cimport vector
+from libc.stdlib cimport malloc, calloc, free
+from libc.string cimport memset
 from numpy cimport float64_t, int8_t, int32_t, int64_t
 cimport cython
+from cython.parallel cimport prange, threadid
+
+cdef extern from "<algorithm>" namespace "std" nogil:
+    void sort[Iter](Iter first, Iter last)
+    Iter lower_bound[Iter, T](Iter first, Iter last, const T& value)
+    Iter upper_bound[Iter, T](Iter first, Iter last, const T& value)
 
 DEF C_START_EVENT = 1
 DEF C_END_EVENT = 0
 
+DEF C_PAIRWISE_TRANSMISSION = 0
+DEF C_CLASS_TRANSMISSION = 1
+
+DEF C_PROB_ACCUMULATION = 0
+DEF C_LOG_SURVIVAL_ACCUMULATION = 1
+
 START_EVENT = 1
 END_EVENT = 0
 
-cdef inline float64_t padd(float64_t p, float64_t q):
+PAIRWISE_TRANSMISSION = 0
+CLASS_TRANSMISSION = 1
+
+PROB_ACCUMULATION = 0
+LOG_SURVIVAL_ACCUMULATION = 1
+
+cdef inline float64_t padd(float64_t p, float64_t q) noexcept nogil:
     """Add the probabilities."""
     return 1.0 - (1.0 - p) * (1.0 - q)
 
 
-cdef inline float64_t pmul(float64_t p, float64_t n):
+cdef inline float64_t pmul(float64_t p, float64_t n) noexcept nogil:
     """Return the multiple of the given probabilty."""
     return 1.0 - cpow(1.0 - p, n)
 
 
+cdef struct IndexSet:
+    # The members of the set stored contiguously
+    int64_t* items
+    # Position of every visit in items (or -1), indexed by visit - offset
+    int64_t* pos
+    int64_t size
+    int64_t offset
+
+
+cdef inline bint iset_insert(IndexSet* s, int64_t i_visit) noexcept nogil:
+    """Add the visit to the set; return whether it wasn't a member."""
+    cdef int64_t k = i_visit - s.offset
+    if s.pos[k] != -1:
+        return False
+
+    s.pos[k] = s.size
+    s.items[s.size] = i_visit
+    s.size += 1
+    return True
+
+
+cdef inline bint iset_erase(IndexSet* s, int64_t i_visit) noexcept nogil:
+    """Remove the visit from the set by swapping in the last member.
+
+    Return whether it was a member.
+    """
+    cdef int64_t k = i_visit - s.offset
+    cdef int64_t i = s.pos[k]
+    if i == -1:
+        return False
+
+    s.size -= 1
+    cdef int64_t last = s.items[s.size]
+    s.items[i] = last
+    s.pos[last - s.offset] = i
+    s.pos[k] = -1
+    return True
+
+
+cdef inline void iset_clear(IndexSet* s, int64_t offset) noexcept nogil:
+    """Remove all members and move the set to a new visit offset."""
+    cdef int64_t i
+    for i in range(s.size):
+        s.pos[s.items[i] - s.offset] = -1
+    s.size = 0
+    s.offset = offset
+
+
+cdef int iset_init(IndexSet* s, int64_t max_visits) noexcept nogil:
+    """Allocate an empty set for locations with upto max_visits visits."""
+    cdef int64_t i
+    s.items = <int64_t*> malloc((max_visits + 1) * sizeof(int64_t))
+    s.pos = <int64_t*> malloc((max_visits + 1) * sizeof(int64_t))
+    s.size = 0
+    s.offset = 0
+    if s.items == NULL or s.pos == NULL:
+        return -1
+
+    for i in range(max_visits):
+        s.pos[i] = -1
+    return 0
+
+
+cdef struct Occupancy:
+    # The scratch space for computing the visit results of a location
+    IndexSet succ_indices
+    IndexSet infc_indices
+    int64_t* succ_class_count
+    int64_t* infc_class_count
+    float64_t* class_survival
+    int64_t n_classes
+    int32_t* starts
+    int32_t* ends
+
+
+cdef int occupancy_init(
+        Occupancy* occ,
+        int64_t max_visits,
+        int64_t n_classes) noexcept nogil:
+    """Allocate the occupancy scratch space."""
+    memset(occ, 0, sizeof(Occupancy))
+    occ.n_classes = n_classes
+
+    if iset_init(&occ.succ_indices, max_visits) != 0:
+        return -1
+    if iset_init(&occ.infc_indices, max_visits) != 0:
+        return -1
+
+    occ.succ_class_count = <int64_t*> calloc(n_classes + 1, sizeof(int64_t))
+    occ.infc_class_count = <int64_t*> calloc(n_classes + 1, sizeof(int64_t))
+    occ.class_survival = <float64_t*> calloc(n_classes + 1, sizeof(float64_t))
+    occ.starts = <int32_t*> malloc((max_visits + 1) * sizeof(int32_t))
+    occ.ends = <int32_t*> malloc((max_visits + 1) * sizeof(int32_t))
+    if (occ.succ_class_count == NULL or occ.infc_class_count == NULL
+            or occ.class_survival == NULL or occ.starts == NULL or occ.ends == NULL):
+        return -1
+    return 0
+
+
+cdef void occupancy_free(Occupancy* occ) noexcept nogil:
+    """Free the occupancy scratch space."""
+    free(occ.succ_indices.items)
+    free(occ.succ_indices.pos)
+    free(occ.infc_indices.items)
+    free(occ.infc_indices.pos)
+    free(occ.succ_class_count)
+    free(occ.infc_class_count)
+    free(occ.class_survival)
+    free(occ.starts)
+    free(occ.ends)
+    memset(occ, 0, sizeof(Occupancy))
+
+
+cdef void occupancy_reset(Occupancy* occ, int64_t v_begin) noexcept nogil:
+    """Reset the occupancy for a location whose visits start at v_begin."""
+    iset_clear(&occ.succ_indices, v_begin)
+    iset_clear(&occ.infc_indices, v_begin)
+    memset(occ.succ_class_count, 0, occ.n_classes * sizeof(int64_t))
+    memset(occ.infc_class_count, 0, occ.n_classes * sizeof(int64_t))
+
+
+cdef Occupancy* occupancy_alloc_many(
+        int64_t n,
+        int64_t max_visits,
+        int64_t n_classes) except NULL:
+    """Allocate the occupancy scratch space for n threads."""
+    cdef int64_t i
+    cdef Occupancy* occs = <Occupancy*> calloc(n, sizeof(Occupancy))
+    if occs == NULL:
+        raise MemoryError()
+
+    for i in range(n):
+        if occupancy_init(&occs[i], max_visits, n_classes) != 0:
+            occupancy_free_many(occs, n)
+            raise MemoryError()
+    return occs
+
+
+cdef void occupancy_free_many(Occupancy* occs, int64_t n) noexcept nogil:
+    """Free the occupancy scratch space of n threads."""
+    cdef int64_t i
+    for i in range(n):
+        occupancy_free(&occs[i])
+    free(occs)
+
+
+def location_order(l_offsets):
+    """Return the location indices, largest locations first, and the largest size."""
+    l_size = np.diff(np.asarray(l_offsets, dtype=np.int64))
+    l_order = np.argsort(-l_size, kind="stable").astype(np.int64)
+    return l_order, int(l_size.max(initial=0))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _location_overlap_counts(
+        int64_t v_begin,
+        int64_t v_end,
+        int32_t[:] v_start_time,
+        int32_t[:] v_end_time,
+        int8_t[:,:] v_attributes,
+        int64_t i_attr,
+        int32_t[:] vo_n_contacts,
+        int32_t[:,:] vo_attributes,
+        Occupancy* occ) noexcept nogil:
+    """Count the overlapping visits of every visit in [v_begin, v_end).
+
+    If i_attr is -1 all other visits are counted in vo_n_contacts,
+    otherwise only the visits having the attribute are counted
+    in vo_attributes[i_attr].
+
+    Two visits overlap if s_j < e_i and s_i < e_j.
+    As e_j <= s_i implies s_j < e_i,
+    the count is |{j: s_j < e_i}| - |{j: e_j <= s_i}| - 1,
+    the 1 being the visit itself.
+    Visits with no duration overlap no one,
+    so they are neither counted nor have any count.
+    """
+    cdef int32_t* starts = occ.starts
+    cdef int32_t* ends = occ.ends
+    cdef int64_t n = 0
+    cdef int64_t i_visit
+    cdef int64_t count
+
+    for i_visit in range(v_begin, v_end):
+        if v_start_time[i_visit] >= v_end_time[i_visit]:
+            continue
+        if i_attr == -1 or v_attributes[i_attr, i_visit]:
+            starts[n] = v_start_time[i_visit]
+            ends[n] = v_end_time[i_visit]
+            n += 1
+    sort(starts, starts + n)
+    sort(ends, ends + n)
+
+    for i_visit in range(v_begin, v_end):
+        if v_start_time[i_visit] >= v_end_time[i_visit]:
+            count = 0
+        else:
+            count = (lower_bound(starts, starts + n, v_end_time[i_visit]) - starts)
+            count -= (upper_bound(ends, ends + n, v_start_time[i_visit]) - ends)
+            if i_attr == -1 or v_attributes[i_attr, i_visit]:
+                count -= 1
+
+        if i_attr == -1:
+            vo_n_contacts[i_visit] = count
+        else:
+            vo_attributes[i_attr, i_visit] = count
+
+
+cdef void _location_contact_counts(
+        int64_t v_begin,
+        int64_t v_end,
+        int32_t[:] v_start_time,
+        int32_t[:] v_end_time,
+        int8_t[:,:] v_attributes,
+        int32_t[:] vo_n_contacts,
+        int32_t[:,:] vo_attributes,
+        Occupancy* occ) noexcept nogil:
+    """Compute the contact and visual attribute counts of a location."""
+    cdef int64_t i_attr
+
+    _location_overlap_counts(
+        v_begin, v_end, v_start_time, v_end_time, v_attributes, -1,
+        vo_n_contacts, vo_attributes, occ)
+    for i_attr in range(v_attributes.shape[0]):
+        _location_overlap_counts(
+            v_begin, v_end, v_start_time, v_end_time, v_attributes, i_attr,
+            vo_n_contacts, vo_attributes, occ)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _location_transmission(
+        float64_t[:,:,:,:,:,:] transmission_prob,
+        float64_t[:,:] succeptibility,
+        float64_t[:,:] infectivity,
+        float64_t unit_time,
+        int64_t v_begin,
+        int64_t v_end,
+        int64_t[:] e_indices_sorted,
+        int64_t[:] e_event_visit,
+        int32_t[:] e_event_time,
+        int8_t[:] e_event_type,
+        int32_t[:] v_start_time,
+        int32_t[:] v_end_time,
+        int8_t[:] v_state,
+        int8_t[:] v_group,
+        int8_t[:] v_behavior,
+        float64_t[:] vo_inf_prob,
+        int64_t transmission_mode,
+        float64_t[:,:,:,:,:,:] log_survival_prob,
+        float64_t[:] vo_log_survival,
+        int64_t accumulation_mode,
+        Occupancy* occ) noexcept nogil:
+    """Compute the infection probabilities for the visits in [v_begin, v_end).
+
+    The visits must belong to one location
+    and their events must be the sorted events in [2 * v_begin, 2 * v_end).
+    Visits with no duration overlap no one, as in the contact counts,
+    so their events are skipped.
+
+    In the pairwise transmission mode
+    every (succeptible, infectious) pair present in an interval
+    is considered individually.
+    In the class transmission mode
+    the occupants are counted per (state, group, behavior) class
+    and the survival probability of every succeptible class
+    is computed once per interval from the infectious class counts.
+
+    In the probability accumulation mode
+    the infection probabilities are accumulated in vo_inf_prob.
+    In the log survival accumulation mode
+    log(1 - p) is accumulated in vo_log_survival instead,
+    using the precomputed log_survival_prob = log1p(-transmission_prob) table,
+    and vo_inf_prob is left untouched.
+    """
+    cdef int64_t n_groups = transmission_prob.shape[1]
+    cdef int64_t n_behaviors = transmission_prob.shape[2]
+    cdef int64_t n_classes = occ.n_classes
+
+    cdef int32_t prev_time = -1
+    cdef int32_t cur_time
+    cdef int8_t event_type
+
+    cdef IndexSet* cur_succ_indices = &occ.succ_indices
+    cdef IndexSet* cur_infc_indices = &occ.infc_indices
+    cdef int64_t* cur_succ_class_count = occ.succ_class_count
+    cdef int64_t* cur_infc_class_count = occ.infc_class_count
+    cdef float64_t* class_survival = occ.class_survival
+
+    occupancy_reset(occ, v_begin)
+
+    cdef int64_t i_event_sorted, i_event, i_visit
+    cdef int64_t i_succ, i_infc
+    cdef int64_t j_succ, j_infc
+    cdef float64_t duration
+    cdef int64_t ss, sg, sb
+    cdef int64_t is_, ig, ib
+    cdef int64_t vs, vg, vc
+    cdef int64_t sc, ic
+    cdef float64_t prob, survival
+
+    for i_event_sorted in range(2 * v_begin, 2 * v_end):
+        i_event = e_indices_sorted[i_event_sorted]
+        i_visit = e_event_visit[i_event]
+        cur_time = e_event_time[i_event]
+        event_type = e_event_type[i_event]
+
+        # Update the infection probabilities
+        if prev_time != -1:
+            duration = cur_time - prev_time
+
+            if duration > 0.0 and cur_succ_indices.size > 0 and cur_infc_indices.size > 0:
+                duration = duration / unit_time
+
+                if transmission_mode == C_CLASS_TRANSMISSION:
+                    for sc in range(n_classes):
+                        if cur_succ_class_count[sc] == 0:
+                            continue
+                        ss = sc // (n_groups * n_behaviors)
+                        sg = (sc // n_behaviors) % n_groups
+                        sb = sc % n_behaviors
+
+                        if accumulation_mode == C_LOG_SURVIVAL_ACCUMULATION:
+                            survival = 0.0
+                        else:
+                            survival = 1.0
+                        for ic in range(n_classes):
+                            if cur_infc_class_count[ic] == 0:
+                                continue
+                            is_ = ic // (n_groups * n_behaviors)
+                            ig = (ic // n_behaviors) % n_groups
+                            ib = ic % n_behaviors
+
+                            if accumulation_mode == C_LOG_SURVIVAL_ACCUMULATION:
+                                survival += log_survival_prob[ss, sg, sb, is_, ig, ib] * cur_infc_class_count[ic]
+                            else:
+                                prob = transmission_prob[ss, sg, sb, is_, ig, ib]
+                                survival *= cpow(1.0 - prob, duration * cur_infc_class_count[ic])
+                        class_survival[sc] = survival
+
+                    for j_succ in range(cur_succ_indices.size):
+                        i_succ = cur_succ_indices.items[j_succ]
+                        vc = (v_state[i_succ] * n_groups + v_group[i_succ]) * n_behaviors + v_behavior[i_succ]
+                        if accumulation_mode == C_LOG_SURVIVAL_ACCUMULATION:
+                            vo_log_survival[i_succ] += duration * class_survival[vc]
+                        else:
+                            vo_inf_prob[i_succ] = 1.0 - (1.0 - vo_inf_prob[i_succ]) * class_survival[vc]
+                else: # transmission_mode == C_PAIRWISE_TRANSMISSION
+                    for j_succ in range(cur_succ_indices.size):
+                        i_succ = cur_succ_indices.items[j_succ]
+                        ss = v_state[i_succ]
+                        sg = v_group[i_succ]
+                        sb = v_behavior[i_succ]
+
+                        for j_infc in range(cur_infc_indices.size):
+                            i_infc = cur_infc_indices.items[j_infc]
+                            is_ = v_state[i_infc]
+                            ig = v_group[i_infc]
+                            ib = v_behavior[i_infc]
+
+                            if accumulation_mode == C_LOG_SURVIVAL_ACCUMULATION:
+                                vo_log_survival[i_succ] += duration * log_survival_prob[ss, sg, sb, is_, ig, ib]
+                            else:
+                                prob = transmission_prob[ss, sg, sb, is_, ig, ib]
+                                prob = pmul(prob, duration)
+                                vo_inf_prob[i_succ] = padd(vo_inf_prob[i_succ], prob)
+
+        prev_time = cur_time
+        if v_start_time[i_visit] >= v_end_time[i_visit]:
+            continue
+
+        # Update the succeptible, infectious user accounting
+        vs = v_state[i_visit]
+        vg = v_group[i_visit]
+        vc = (vs * n_groups + vg) * n_behaviors + v_behavior[i_visit]
+        if event_type == C_START_EVENT:
+            if succeptibility[vs, vg] > 0.0:
+                if iset_insert(cur_succ_indices, i_visit):
+                    cur_succ_class_count[vc] += 1
+            if infectivity[vs, vg] > 0.0:
+                if iset_insert(cur_infc_indices, i_visit):
+                    cur_infc_class_count[vc] += 1
+        else: # event_type == END_EVENT
+            if succeptibility[vs, vg] > 0.0:
+                if iset_erase(cur_succ_indices, i_visit):
+                    cur_succ_class_count[vc] -= 1
+            if infectivity[vs, vg] > 0.0:
+                if iset_erase(cur_infc_indices, i_visit):
+                    cur_infc_class_count[vc] -= 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _location_visit_output(
+        float64_t[:,:,:,:,:,:] transmission_prob,
+        float64_t[:,:] succeptibility,
+        float64_t[:,:] infectivity,
+        float64_t unit_time,
+        int64_t v_begin,
+        int64_t v_end,
+        int64_t[:] e_indices_sorted,
+        int64_t[:] e_event_visit,
+        int32_t[:] e_event_time,
+        int8_t[:] e_event_type,
+        int32_t[:] v_start_time,
+        int32_t[:] v_end_time,
+        int8_t[:] v_state,
+        int8_t[:] v_group,
+        int8_t[:] v_behavior,
+        int8_t[:,:] v_attributes,
+        float64_t[:] vo_inf_prob,
+        int32_t[:] vo_n_contacts,
+        int32_t[:,:] vo_attributes,
+        int64_t transmission_mode,
+        float64_t[:,:,:,:,:,:] log_survival_prob,
+        float64_t[:] vo_log_survival,
+        int64_t accumulation_mode,
+        Occupancy* occ) noexcept nogil:
+    """Compute the visit results for the visits in [v_begin, v_end).
+
+    The transmission step is skipped for locations
+    without both a succeptible and an infectious visit.
+    """
+    cdef bint has_succ = False
+    cdef bint has_infc = False
+    cdef int64_t i_visit
+
+    _location_contact_counts(
+        v_begin, v_end, v_start_time, v_end_time, v_attributes,
+        vo_n_contacts, vo_attributes, occ)
+
+    for i_visit in range(v_begin, v_end):
+        if succeptibility[v_state[i_visit], v_group[i_visit]] > 0.0:
+            has_succ = True
+        if infectivity[v_state[i_visit], v_group[i_visit]] > 0.0:
+            has_infc = True
+    if not (has_succ and has_infc):
+        return
+
+    _location_transmission(
+        transmission_prob, succeptibility, infectivity, unit_time,
+        v_begin, v_end,
+        e_indices_sorted, e_event_visit, e_event_time, e_event_type,
+        v_start_time, v_end_time,
+        v_state, v_group, v_behavior,
+        vo_inf_prob,
+        transmission_mode,
+        log_survival_prob, vo_log_survival, accumulation_mode,
+        occ)
+
+
 @cython.boundscheck(True)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -37,22 +512,31 @@ def compute_visit_output_cy(
         int64_t[:] e_event_visit not None,
         int32_t[:] e_event_time not None,
         int8_t[:] e_event_type not None,
+        int32_t[:] v_start_time not None,
+        int32_t[:] v_end_time not None,
         int8_t[:] v_state not None,
         int8_t[:] v_group not None,
         int8_t[:] v_behavior not None,
         int8_t[:,:] v_attributes not None,
         float64_t[:] vo_inf_prob not None,
         int32_t[:] vo_n_contacts not None,
-        int32_t[:,:] vo_attributes not None):
+        int32_t[:,:] vo_attributes not None,
+        int64_t transmission_mode=C_PAIRWISE_TRANSMISSION,
+        float64_t[:,:,:,:,:,:] log_survival_prob=None,
+        float64_t[:] vo_log_survival=None,
+        int64_t accumulation_mode=C_PROB_ACCUMULATION):
     """Compute the visit results."""
     cdef int64_t n_events = e_indices_sorted.shape[0]
     assert n_events > 0
+    assert n_events == 2 * v_state.shape[0]
     assert e_event_visit.shape[0] == n_events
     assert e_event_time.shape[0] == n_events
     assert e_event_type.shape[0] == n_events
 
     cdef int64_t n_visits = v_state.shape[0]
     assert n_visits > 0
+    assert v_start_time.shape[0] == n_visits
+    assert v_end_time.shape[0] == n_visits
     assert v_group.shape[0] == n_visits
     assert v_behavior.shape[0] == n_visits
     assert v_attributes.shape[1] == n_visits
@@ -65,94 +549,179 @@ def compute_visit_output_cy(
     assert vo_attributes.shape[0] == n_attributes
 
     assert unit_time > 0
+    assert transmission_mode in (C_PAIRWISE_TRANSMISSION, C_CLASS_TRANSMISSION)
+    assert accumulation_mode in (C_PROB_ACCUMULATION, C_LOG_SURVIVAL_ACCUMULATION)
+    if accumulation_mode == C_LOG_SURVIVAL_ACCUMULATION:
+        assert log_survival_prob is not None
+        assert vo_log_survival is not None
+        assert vo_log_survival.shape[0] == n_visits
 
-    cdef int64_t cur_occupancy = 0
-    cdef int32_t prev_time = -1
-    cdef int32_t cur_time
-    cdef int8_t event_type
-    cdef unordered_set[int64_t] cur_all_indices
-    cdef unordered_set[int64_t] cur_succ_indices
-    cdef unordered_set[int64_t] cur_infc_indices
-    cdef vector[int64_t] cur_attr_count;
+    cdef int64_t n_classes = (
+        transmission_prob.shape[0] * transmission_prob.shape[1] * transmission_prob.shape[2])
+    cdef Occupancy occ
+    if occupancy_init(&occ, n_visits, n_classes) != 0:
+        occupancy_free(&occ)
+        raise MemoryError()
 
-    cur_attr_count.resize(n_attributes, 0)
+    with nogil:
+        _location_visit_output(
+            transmission_prob, succeptibility, infectivity, unit_time,
+            0, n_visits,
+            e_indices_sorted, e_event_visit, e_event_time, e_event_type,
+            v_start_time, v_end_time,
+            v_state, v_group, v_behavior, v_attributes,
+            vo_inf_prob, vo_n_contacts, vo_attributes,
+            transmission_mode,
+            log_survival_prob, vo_log_survival, accumulation_mode,
+            &occ)
 
-    cdef int64_t i_event_sorted, i_event, i_visit
-    cdef int64_t i_succ, i_infc
-    cdef int64_t i_attr, i_present
-    cdef float64_t duration
-    cdef int64_t ss, sg, sb
-    cdef int64_t is_, ig, ib
-    cdef int64_t vs, vg
-    cdef float64_t prob
+    occupancy_free(&occ)
 
-    for i_event_sorted in range(n_events):
-        i_event = e_indices_sorted[i_event_sorted]
-        i_visit = e_event_visit[i_event]
-        cur_time = e_event_time[i_event]
-        event_type = e_event_type[i_event]
 
-        # Update the infection probabilities
-        if prev_time != -1:
-            duration = cur_time - prev_time
+@cython.boundscheck(True)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def compute_visit_output_batch_cy(
+        float64_t[:,:,:,:,:,:] transmission_prob not None,
+        float64_t[:,:] succeptibility not None,
+        float64_t[:,:] infectivity not None,
+        float64_t unit_time,
+        int64_t[:] l_offsets not None,
+        int64_t[:] e_indices_sorted not None,
+        int64_t[:] e_event_visit not None,
+        int32_t[:] e_event_time not None,
+        int8_t[:] e_event_type not None,
+        int32_t[:] v_start_time not None,
+        int32_t[:] v_end_time not None,
+        int8_t[:] v_state not None,
+        int8_t[:] v_group not None,
+        int8_t[:] v_behavior not None,
+        int8_t[:,:] v_attributes not None,
+        float64_t[:] vo_inf_prob not None,
+        int32_t[:] vo_n_contacts not None,
+        int32_t[:,:] vo_attributes not None,
+        int64_t transmission_mode=C_PAIRWISE_TRANSMISSION,
+        float64_t[:,:,:,:,:,:] log_survival_prob=None,
+        float64_t[:] vo_log_survival=None,
+        int64_t accumulation_mode=C_PROB_ACCUMULATION,
+        int num_threads=1):
+    """Compute the visit results of many locations in one call.
 
-            if duration > 0.0 and cur_succ_indices.size() > 0 and cur_infc_indices.size() > 0:
-                duration = duration / unit_time
+    The visits must be sorted by location,
+    with the visits of location l being in [l_offsets[l], l_offsets[l + 1]).
+    Every visit has a start and an end event,
+    and the events must be sorted by (location, time, type);
+    so the events of location l are the sorted events
+    in [2 * l_offsets[l], 2 * l_offsets[l + 1]).
 
-                for i_succ in cur_succ_indices:
-                    ss = v_state[i_succ]
-                    sg = v_group[i_succ]
-                    sb = v_behavior[i_succ]
+    The locations are spread over num_threads threads,
+    largest locations first, with dynamic scheduling.
+    The locations are independent and write disjoint output rows,
+    so the results don't depend on the number of threads.
+    """
+    cdef int64_t n_locations = l_offsets.shape[0] - 1
+    assert n_locations >= 0
 
-                    for i_infc in cur_infc_indices:
-                        is_ = v_state[i_infc]
-                        ig = v_group[i_infc]
-                        ib = v_behavior[i_infc]
+    cdef int64_t n_visits = v_state.shape[0]
+    assert l_offsets[0] == 0
+    assert l_offsets[n_locations] == n_visits
+    assert v_start_time.shape[0] == n_visits
+    assert v_end_time.shape[0] == n_visits
+    assert v_group.shape[0] == n_visits
+    assert v_behavior.shape[0] == n_visits
+    assert v_attributes.shape[1] == n_visits
+    assert vo_inf_prob.shape[0] == n_visits
+    assert vo_n_contacts.shape[0] == n_visits
+    assert vo_attributes.shape[1] == n_visits
 
-                        prob = transmission_prob[ss, sg, sb, is_, ig, ib]
-                        prob = pmul(prob, duration)
-                        vo_inf_prob[i_succ] = padd(vo_inf_prob[i_succ], prob)
+    cdef int64_t n_events = e_indices_sorted.shape[0]
+    assert n_events == 2 * n_visits
+    assert e_event_visit.shape[0] == n_events
+    assert e_event_time.shape[0] == n_events
+    assert e_event_type.shape[0] == n_events
 
-        # Update visual attribute accounting
-        if event_type == C_START_EVENT:
-            # The incoming agent sees everyone
-            for i_attr in range(n_attributes):
-                vo_attributes[i_attr, i_visit] = cur_attr_count[i_attr]
-            vo_n_contacts[i_visit] = cur_occupancy
-
-            # Every present agent sees incoming agent
-            for i_attr in range(n_attributes):
-                if v_attributes[i_attr, i_visit]:
-                    for i_present in cur_all_indices:
-                        vo_attributes[i_attr, i_present] += 1
-            for i_present in cur_all_indices:
-                vo_n_contacts[i_present] += 1
-
-            # Update the visual attribute count
-            for i_attr in range(n_attributes):
-                if vo_attributes[i_attr, i_visit]:
-                    cur_attr_count[i_attr] += 1
-            cur_occupancy += 1
-        else: # event_type == END_EVENT
-            for i_attr in range(n_attributes):
-                if v_attributes[i_attr, i_visit]:
-                    cur_attr_count[i_attr] -= 1
-            cur_occupancy -= 1
+    cdef int64_t n_attributes = v_attributes.shape[0]
+    assert n_attributes > 0
+    assert vo_attributes.shape[0] == n_attributes
 
-        # Update the succeptible, infectious user accounting
-        vs = v_state[i_visit]
-        vg = v_group[i_visit]
-        if event_type == C_START_EVENT:
-            cur_all_indices.insert(i_visit)
-            if succeptibility[vs, vg] > 0.0:
-                cur_succ_indices.insert(i_visit)
-            if infectivity[vs, vg] > 0.0:
-                cur_infc_indices.insert(i_visit)
-        else: # event_type == END_EVENT
-            cur_all_indices.erase(i_visit)
-            if succeptibility[vs, vg] > 0.0:
-                cur_succ_indices.erase(i_visit)
-            if infectivity[vs, vg] > 0.0:
-                cur_infc_indices.erase(i_visit)
+    assert unit_time > 0
+    assert transmission_mode in (C_PAIRWISE_TRANSMISSION, C_CLASS_TRANSMISSION)
+    assert accumulation_mode in (C_PROB_ACCUMULATION, C_LOG_SURVIVAL_ACCUMULATION)
+    if accumulation_mode == C_LOG_SURVIVAL_ACCUMULATION:
+        assert log_survival_prob is not None
+        assert vo_log_survival is not None
+        assert vo_log_survival.shape[0] == n_visits
 
-        prev_time = cur_time
+    assert num_threads > 0
+
+    cdef int64_t n_classes = (
+        transmission_prob.shape[0] * transmission_prob.shape[1] * transmission_prob.shape[2])
+    cdef int64_t j_loc, i_loc
+    cdef int64_t[:] l_order
+    cdef int64_t max_visits
+    l_order, max_visits = location_order(l_offsets)
+
+    cdef Occupancy* occs = occupancy_alloc_many(num_threads, max_visits, n_classes)
+
+    with nogil:
+        for j_loc in prange(n_locations, schedule="dynamic", num_threads=num_threads):
+            i_loc = l_order[j_loc]
+            _location_visit_output(
+                transmission_prob, succeptibility, infectivity, unit_time,
+                l_offsets[i_loc], l_offsets[i_loc + 1],
+                e_indices_sorted, e_event_visit, e_event_time, e_event_type,
+                v_start_time, v_end_time,
+                v_state, v_group, v_behavior, v_attributes,
+                vo_inf_prob, vo_n_contacts, vo_attributes,
+                transmission_mode,
+                log_survival_prob, vo_log_survival, accumulation_mode,
+                &occs[threadid()])
+
+    occupancy_free_many(occs, num_threads)
+
+
+@cython.boundscheck(True)
+@cython.wraparound(False)
+def compute_contact_counts_cy(
+        int64_t[:] l_offsets not None,
+        int32_t[:] v_start_time not None,
+        int32_t[:] v_end_time not None,
+        int8_t[:,:] v_attributes not None,
+        int32_t[:] vo_n_contacts not None,
+        int32_t[:,:] vo_attributes not None,
+        int num_threads=1):
+    """Compute only the contact and visual attribute counts of many locations.
+
+    The visits must be sorted by location,
+    with the visits of location l being in [l_offsets[l], l_offsets[l + 1]).
+    """
+    cdef int64_t n_locations = l_offsets.shape[0] - 1
+    assert n_locations >= 0
+
+    cdef int64_t n_visits = v_start_time.shape[0]
+    assert l_offsets[0] == 0
+    assert l_offsets[n_locations] == n_visits
+    assert v_end_time.shape[0] == n_visits
+    assert v_attributes.shape[1] == n_visits
+    assert vo_n_contacts.shape[0] == n_visits
+    assert vo_attributes.shape[1] == n_visits
+    assert vo_attributes.shape[0] == v_attributes.shape[0]
+    assert num_threads > 0
+
+    cdef int64_t j_loc, i_loc
+    cdef int64_t[:] l_order
+    cdef int64_t max_visits
+    l_order, max_visits = location_order(l_offsets)
+
+    cdef Occupancy* occs = occupancy_alloc_many(num_threads, max_visits, 0)
+
+    with nogil:
+        for j_loc in prange(n_locations, schedule="dynamic", num_threads=num_threads):
+            i_loc = l_order[j_loc]
+            _location_contact_counts(
+                l_offsets[i_loc], l_offsets[i_loc + 1],
+                v_start_time, v_end_time, v_attributes,
+                vo_n_contacts, vo_attributes,
+                &occs[threadid()])
+
+    occupancy_free_many(occs, num_threads)
@@ -0,0 +1,259 @@
+"""Visit computation vectorized numpy version."""
+
+import numpy as np
+
+START_EVENT = 1
+END_EVENT = 0
+
+PAIRWISE_TRANSMISSION = 0
+CLASS_TRANSMISSION = 1
+
+PROB_ACCUMULATION = 0
+LOG_SURVIVAL_ACCUMULATION = 1
+
+# Maximum number of (succeptible, infectious) visit pairs handled at once
+MAX_CHUNK_PAIRS = 1 << 20
+
+
+def _visit_location(l_offsets):
+    """Return the location index of every visit."""
+    l_size = np.diff(l_offsets)
+    return np.repeat(np.arange(len(l_size), dtype=np.int64), l_size)
+
+
+def _location_time_keys(v_location, v_start_time, v_end_time):
+    """Return the start and end times as keys sorting by (location, time)."""
+    n_visits = len(v_location)
+    if n_visits == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    t_min = int(min(v_start_time.min(), v_end_time.min()))
+    t_max = int(max(v_start_time.max(), v_end_time.max()))
+    span = t_max - t_min + 1
+    if (int(v_location[-1]) + 1) * span >= np.iinfo(np.int64).max:
+        raise ValueError("Visit times span too large to compute the counts.")
+
+    base = v_location * span - t_min
+    start_key = base + v_start_time.astype(np.int64)
+    end_key = base + v_end_time.astype(np.int64)
+    return start_key, end_key
+
+
+def _overlap_counts(start_key, end_key, has_duration, mask):
+    """Count the overlapping visits, having mask set, of every visit.
+
+    Two visits overlap if s_j < e_i and s_i < e_j.
+    As e_j <= s_i implies s_j < e_i,
+    the count is |{j: s_j < e_i}| - |{j: e_j <= s_i}| - 1,
+    the 1 being the visit itself.
+    The keys of the earlier locations add equally to both terms.
+    Visits with no duration overlap no one,
+    so they are neither counted nor have any count.
+    """
+    starts = np.sort(start_key[mask & has_duration])
+    ends = np.sort(end_key[mask & has_duration])
+
+    count = np.searchsorted(starts, end_key, side="left")
+    count -= np.searchsorted(ends, start_key, side="right")
+    count -= mask
+    count[~has_duration] = 0
+    return count
+
+
+def compute_contact_counts_np(
+    l_offsets,
+    v_start_time,
+    v_end_time,
+    v_attributes,
+    vo_n_contacts,
+    vo_attributes,
+):
+    """Compute only the contact and visual attribute counts of many locations.
+
+    The visits must be sorted by location,
+    with the visits of location l being in [l_offsets[l], l_offsets[l + 1]).
+    """
+    n_visits = v_start_time.shape[0]
+    assert l_offsets[0] == 0
+    assert l_offsets[-1] == n_visits
+    assert v_end_time.shape[0] == n_visits
+    assert v_attributes.shape[1] == n_visits
+    assert vo_n_contacts.shape[0] == n_visits
+    assert vo_attributes.shape == v_attributes.shape
+
+    v_location = _visit_location(l_offsets)
+    start_key, end_key = _location_time_keys(v_location, v_start_time, v_end_time)
+    has_duration = v_start_time < v_end_time
+
+    mask = np.ones(n_visits, dtype=bool)
+    vo_n_contacts[:] = _overlap_counts(start_key, end_key, has_duration, mask)
+    for i_attr in range(v_attributes.shape[0]):
+        mask = v_attributes[i_attr] != 0
+        vo_attributes[i_attr] = _overlap_counts(start_key, end_key, has_duration, mask)
+
+
+def _pair_chunks(n_pairs):
+    """Split the succeptible visits into chunks of about MAX_CHUNK_PAIRS pairs.
+
+    Every chunk has at least one visit,
+    so a single visit with more pairs forms a chunk of its own.
+    """
+    cum_pairs = np.cumsum(n_pairs)
+    begin = 0
+    while begin < len(n_pairs):
+        done = cum_pairs[begin - 1] if begin > 0 else 0
+        end = np.searchsorted(cum_pairs, done + MAX_CHUNK_PAIRS, side="right")
+        end = max(int(end), begin + 1)
+        yield begin, end
+        begin = end
+
+
+def _log_survival(
+    log_survival_prob,
+    succeptibility,
+    infectivity,
+    unit_time,
+    l_offsets,
+    v_start_time,
+    v_end_time,
+    v_state,
+    v_group,
+    v_behavior,
+):
+    """Return the log survival probability of every visit.
+
+    The overlap durations of all (succeptible, infectious) visit pairs
+    of a location are computed as one interval overlap matrix,
+    flattened and processed in chunks of succeptible visits.
+    """
+    n_visits = v_start_time.shape[0]
+    log_survival = np.zeros(n_visits, dtype=np.float64)
+
+    i_succ = np.flatnonzero(succeptibility[v_state, v_group] > 0.0)
+    i_infc = np.flatnonzero(infectivity[v_state, v_group] > 0.0)
+    if len(i_succ) == 0 or len(i_infc) == 0:
+        return log_survival
+
+    # The infectious visits of location l are
+    # i_infc[infc_offsets[l]:infc_offsets[l + 1]]
+    infc_offsets = np.searchsorted(i_infc, l_offsets)
+    succ_location = _visit_location(l_offsets)[i_succ]
+    infc_begin = infc_offsets[succ_location]
+    n_pairs = infc_offsets[succ_location + 1] - infc_begin
+
+    v_start_time = v_start_time.astype(np.int64)
+    v_end_time = v_end_time.astype(np.int64)
+
+    for begin, end in _pair_chunks(n_pairs):
+        counts = n_pairs[begin:end]
+        total = counts.sum()
+        if total == 0:
+            continue
+
+        pair_offsets = np.cumsum(counts) - counts
+        within = np.arange(total) - np.repeat(pair_offsets, counts)
+        s = np.repeat(i_succ[begin:end], counts)
+        i = i_infc[np.repeat(infc_begin[begin:end], counts) + within]
+
+        duration = np.minimum(v_end_time[s], v_end_time[i])
+        duration -= np.maximum(v_start_time[s], v_start_time[i])
+        keep = duration > 0
+        s, i, duration = s[keep], i[keep], duration[keep]
+
+        prob = log_survival_prob[
+            v_state[s], v_group[s], v_behavior[s], v_state[i], v_group[i], v_behavior[i]
+        ]
+        weights = prob * (duration / unit_time)
+
+        first = i_succ[begin]
+        n_rows = i_succ[end - 1] - first + 1
+        log_survival[first : first + n_rows] += np.bincount(
+            s - first, weights=weights, minlength=n_rows
+        )
+
+    return log_survival
+
+
+def compute_visit_output_batch_np(
+    transmission_prob,
+    succeptibility,
+    infectivity,
+    unit_time,
+    l_offsets,
+    e_indices_sorted,
+    e_event_visit,
+    e_event_time,
+    e_event_type,
+    v_start_time,
+    v_end_time,
+    v_state,
+    v_group,
+    v_behavior,
+    v_attributes,
+    vo_inf_prob,
+    vo_n_contacts,
+    vo_attributes,
+    transmission_mode=PAIRWISE_TRANSMISSION,
+    log_survival_prob=None,
+    vo_log_survival=None,
+    accumulation_mode=PROB_ACCUMULATION,
+    num_threads=1,
+):
+    """Compute the visit results of many locations in one call.
+
+    Takes the same arguments as compute_visit_output_batch_cy.
+    The events are not used, the interval overlaps are computed directly
+    from the visit start and end times.
+    Both transmission modes give the same result here,
+    and the computation is always single threaded.
+    """
+    n_visits = v_state.shape[0]
+    assert l_offsets[0] == 0
+    assert l_offsets[-1] == n_visits
+    assert v_start_time.shape[0] == n_visits
+    assert v_end_time.shape[0] == n_visits
+    assert v_group.shape[0] == n_visits
+    assert v_behavior.shape[0] == n_visits
+    assert vo_inf_prob.shape[0] == n_visits
+    assert unit_time > 0
+    assert num_threads > 0
+
+    if transmission_mode not in (PAIRWISE_TRANSMISSION, CLASS_TRANSMISSION):
+        raise ValueError("Unknown transmission mode: %s" % transmission_mode)
+    if accumulation_mode == LOG_SURVIVAL_ACCUMULATION:
+        assert log_survival_prob is not None
+        assert vo_log_survival is not None
+        assert vo_log_survival.shape[0] == n_visits
+    elif accumulation_mode != PROB_ACCUMULATION:
+        raise ValueError("Unknown accumulation mode: %s" % accumulation_mode)
+
+    if log_survival_prob is None:
+        with np.errstate(divide="ignore"):
+            log_survival_prob = np.log1p(-np.asarray(transmission_prob))
+
+    compute_contact_counts_np(
+        l_offsets,
+        v_start_time,
+        v_end_time,
+        v_attributes,
+        vo_n_contacts,
+        vo_attributes,
+    )
+
+    log_survival = _log_survival(
+        np.asarray(log_survival_prob),
+        np.asarray(succeptibility),
+        np.asarray(infectivity),
+        unit_time,
+        np.asarray(l_offsets),
+        v_start_time,
+        v_end_time,
+        v_state,
+        v_group,
+        v_behavior,
+    )
+
+    if accumulation_mode == LOG_SURVIVAL_ACCUMULATION:
+        vo_log_survival += log_survival
+    else:
+        vo_inf_prob[:] = -np.expm1(np.log1p(-vo_inf_prob) + log_survival)
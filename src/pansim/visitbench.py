@@ -0,0 +1,131 @@
+"""Microbenchmark for the visit computation."""
+
+import time
+
+import click
+
+from .disease_model import DiseaseModel, TRANSMISSION_MODES, ACCUMULATION_MODES
+from .visit_computation import VISIT_BACKENDS
+from .visitcheck import make_random_visits
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--disease-model",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, file_okay=True),
+    help="The disease model file.",
+)
+@click.option(
+    "-a",
+    "--visual-attributes",
+    default="coughing,mask,sdist",
+    show_default=True,
+    help="Comma separated visual attributes.",
+)
+@click.option(
+    "-z",
+    "--location-sizes",
+    default="10,100,1000,10000",
+    show_default=True,
+    help="Comma separated number of occupants per location.",
+)
+@click.option(
+    "-n",
+    "--num-visits",
+    default=100000,
+    show_default=True,
+    help="Total number of visits per location size",
+)
+@click.option(
+    "-m",
+    "--max-duration",
+    default=3600,
+    show_default=True,
+    help="Maximum visit duration",
+)
+@click.option(
+    "-t",
+    "--transmission-mode",
+    default="class",
+    show_default=True,
+    type=click.Choice(list(TRANSMISSION_MODES)),
+    help="The transmission mode.",
+)
+@click.option(
+    "-c",
+    "--accumulation-mode",
+    default="prob",
+    show_default=True,
+    type=click.Choice(list(ACCUMULATION_MODES)),
+    help="The accumulation mode.",
+)
+@click.option(
+    "-b",
+    "--visit-backend",
+    default="auto",
+    show_default=True,
+    type=click.Choice(["auto"] + list(VISIT_BACKENDS)),
+    help="The visit computation backend.",
+)
+@click.option(
+    "-j",
+    "--num-threads",
+    default=1,
+    show_default=True,
+    help="Number of visit computation threads",
+)
+@click.option("-r", "--repeat", default=3, show_default=True, help="Number of repeats")
+@click.option("-s", "--seed", default=42, show_default=True, help="Random seed")
+def visitbench(
+    disease_model,
+    visual_attributes,
+    location_sizes,
+    num_visits,
+    max_duration,
+    transmission_mode,
+    accumulation_mode,
+    visit_backend,
+    num_threads,
+    repeat,
+    seed,
+):
+    """Time the visit computation at different location sizes.
+
+    All visits of a location start within max duration of each other,
+    so most of the occupants of a location are present at the same time.
+    """
+    visual_attributes = visual_attributes.strip().split(",")
+    location_sizes = [int(z) for z in location_sizes.strip().split(",")]
+
+    model = DiseaseModel(
+        disease_model,
+        transmission_mode=transmission_mode,
+        accumulation_mode=accumulation_mode,
+        num_threads=num_threads,
+        visit_backend=visit_backend,
+    )
+
+    for size in location_sizes:
+        n_locations = max(1, num_visits // size)
+        visits = make_random_visits(
+            model,
+            visual_attributes,
+            n_locations * size,
+            n_locations,
+            max_duration,
+            seed,
+            max_start_time=max_duration,
+        )
+
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.compute_visit_outputs(visits, visual_attributes)
+            best = min(best, time.perf_counter() - start)
+
+        print(
+            "location_size=%d n_locations=%d n_visits=%d time=%.4f us_per_visit=%.3f"
+            % (size, n_locations, len(visits), best, best / len(visits) * 1e6)
+        )
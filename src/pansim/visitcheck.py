@@ -0,0 +1,214 @@
+"""Consistency checks for the visit computation."""
+
+import itertools
+
+import click
+import numpy as np
+import pandas as pd
+
+from .disease_model import DiseaseModel, TRANSMISSION_MODES, ACCUMULATION_MODES
+from .visit_computation import VISIT_BACKENDS
+
+# The cython backend running the pairwise kernel,
+# which is implemented independently of the numpy backend
+REFERENCE_MODE = ("cython", "pairwise", "prob")
+
+
+def make_random_visits(
+    disease_model,
+    visual_attributes,
+    n_visits,
+    n_locations,
+    max_duration,
+    seed,
+    max_start_time=86400,
+    time_step=60,
+    zero_duration_fraction=0.0,
+):
+    """Return a random visit dataframe for the given disease model.
+
+    The times are multiples of time_step, so that visits at a location
+    share start and end times, and some visits have no duration.
+    Also zero_duration_fraction of the visits are made to have no duration.
+    """
+    rng = np.random.default_rng(seed)
+
+    start_time = rng.integers(0, max_start_time // time_step, n_visits) * time_step
+    duration = (
+        rng.integers(0, max_duration // time_step, n_visits, endpoint=True) * time_step
+    )
+    duration[rng.random(n_visits) < zero_duration_fraction] = 0
+
+    visits = {
+        "lid": rng.integers(0, n_locations, n_visits),
+        "pid": np.arange(n_visits),
+        "group": rng.integers(0, disease_model.n_groups, n_visits),
+        "state": rng.integers(0, disease_model.n_states, n_visits),
+        "behavior": rng.integers(0, disease_model.n_behaviors, n_visits),
+        "start_time": start_time,
+        "end_time": start_time + duration,
+    }
+    for attr in visual_attributes:
+        visits[attr] = rng.integers(0, 2, n_visits)
+
+    return pd.DataFrame(visits)
+
+
+def compare_visit_outputs(expected, actual, visual_attributes):
+    """Return the errors between two visit outputs of the same visits.
+
+    Returns the maximum absolute and relative inf_prob errors
+    and the number of mismatched count values.
+    """
+    expected = pd.DataFrame(expected).sort_values(["lid", "pid"], kind="stable")
+    actual = pd.DataFrame(actual).sort_values(["lid", "pid"], kind="stable")
+
+    p = expected.inf_prob.to_numpy()
+    q = actual.inf_prob.to_numpy()
+    abs_err = np.abs(p - q)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_err = np.where(p > 0, abs_err / p, abs_err)
+
+    count_columns = ["n_contacts"] + list(visual_attributes)
+    n_mismatch = (
+        expected[count_columns].to_numpy() != actual[count_columns].to_numpy()
+    ).sum()
+
+    return abs_err.max(initial=0.0), rel_err.max(initial=0.0), int(n_mismatch)
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--disease-model",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, file_okay=True),
+    help="The disease model file.",
+)
+@click.option(
+    "-a",
+    "--visual-attributes",
+    default="coughing,mask,sdist",
+    show_default=True,
+    help="Comma separated visual attributes.",
+)
+@click.option(
+    "-n", "--num-visits", default=20000, show_default=True, help="Number of visits"
+)
+@click.option(
+    "-l",
+    "--num-locations",
+    default=200,
+    show_default=True,
+    help="Number of locations",
+)
+@click.option(
+    "-m",
+    "--max-duration",
+    default=7200,
+    show_default=True,
+    help="Maximum visit duration",
+)
+@click.option(
+    "-z",
+    "--zero-duration-fraction",
+    default=0.0,
+    show_default=True,
+    help="Fraction of visits with no duration",
+)
+@click.option("-s", "--seed", default=42, show_default=True, help="Random seed")
+@click.option(
+    "-t",
+    "--tolerance",
+    default=1e-9,
+    show_default=True,
+    help="Maximum allowed absolute inf_prob error",
+)
+@click.option(
+    "-j",
+    "--num-threads",
+    default=4,
+    show_default=True,
+    help="Number of threads to check against the single threaded results",
+)
+def visitcheck(
+    disease_model,
+    visual_attributes,
+    num_visits,
+    num_locations,
+    max_duration,
+    zero_duration_fraction,
+    seed,
+    tolerance,
+    num_threads,
+):
+    """Check the visit computation backends and modes against the pairwise kernel.
+
+    The reference is the pairwise kernel of the cython backend,
+    so the extension has to be built.
+    Also check that every mode gives identical results
+    when the locations are spread over multiple threads.
+    """
+    if REFERENCE_MODE[0] not in VISIT_BACKENDS:
+        raise click.ClickException(
+            "The reference %s visit backend is not available; "
+            "build the extension to check the visit computation." % REFERENCE_MODE[0]
+        )
+
+    visual_attributes = visual_attributes.strip().split(",")
+
+    models = {}
+    for mode in itertools.product(
+        VISIT_BACKENDS, TRANSMISSION_MODES, ACCUMULATION_MODES
+    ):
+        visit_backend, transmission_mode, accumulation_mode = mode
+        models[mode] = DiseaseModel(
+            disease_model,
+            transmission_mode=transmission_mode,
+            accumulation_mode=accumulation_mode,
+            visit_backend=visit_backend,
+        )
+
+    visits = make_random_visits(
+        models[REFERENCE_MODE],
+        visual_attributes,
+        num_visits,
+        num_locations,
+        max_duration,
+        seed,
+        zero_duration_fraction=zero_duration_fraction,
+    )
+
+    expected = models[REFERENCE_MODE].compute_visit_outputs(visits, visual_attributes)
+
+    failed = False
+    for mode, model in models.items():
+        actual = model.compute_visit_outputs(visits, visual_attributes)
+        if mode != REFERENCE_MODE:
+            abs_err, rel_err, n_mismatch = compare_visit_outputs(
+                expected, actual, visual_attributes
+            )
+            ok = abs_err <= tolerance and n_mismatch == 0
+            failed = failed or not ok
+
+            print(
+                "%-6s %-8s %-12s max_abs_err=%.3e max_rel_err=%.3e count_mismatch=%d %s"
+                % (*mode, abs_err, rel_err, n_mismatch, "ok" if ok else "FAILED")
+            )
+
+        model.num_threads = num_threads
+        threaded = model.compute_visit_outputs(visits, visual_attributes)
+        model.num_threads = 1
+        abs_err, _, n_mismatch = compare_visit_outputs(
+            actual, threaded, visual_attributes
+        )
+        ok = abs_err == 0 and n_mismatch == 0
+        failed = failed or not ok
+
+        print(
+            "%-6s %-8s %-12s num_threads=%d identical=%s"
+            % (*mode, num_threads, "yes" if ok else "no")
+        )
+
+    if failed:
+        raise click.ClickException("Visit computation backends and modes don't agree.")
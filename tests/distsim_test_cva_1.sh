@@ -29,6 +29,14 @@ export OUTPUT_FILE="distsim_test_cva_epicurve.csv"
 
 export PER_NODE_BEHAVIOR=0
 export JAVA_BEHAVIOR=0
+export EXCHANGE_MODE=${EXCHANGE_MODE:-actor}
+export SHM_TRANSPORT=${SHM_TRANSPORT:-0}
+export IPC_COMPRESSION=${IPC_COMPRESSION:-none}
+export ID_TYPE=${ID_TYPE:-int64}
+export COMPACT_DTYPES=${COMPACT_DTYPES:-0}
+export PIPELINE=${PIPELINE:-0}
+export VISIT_OUTPUT_CHUNKS=${VISIT_OUTPUT_CHUNKS:-1}
+#export ROUTING_DIR=routing_tables
 
 N_CPUS=6
 export XACTOR_MAX_SEND_BUFFERS=$((4 * $N_CPUS))
@@ -0,0 +1,8 @@
+#!/bin/bash
+# Check the visit computation modes against each other
+
+set -Eeuo pipefail
+
+pansim visitcheck -d disease_models/seiar.toml -n 20000 -l 200
+pansim visitcheck -d disease_models/seiar.toml -n 5000 -l 2
+pansim visitcheck -d disease_models/seiar.toml -n 5000 -l 20 -z 0.3